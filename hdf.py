@@ -5,7 +5,11 @@ Created on 29 Jun 2015
 :author: yaswant.pradhan
 :copyright: Crown copyright. Met Office
 '''
+import glob
+import json
+import os
 import sys
+import threading
 import numpy as np
 from pyhdf.SD import SD, SDC
 from pyhdf.error import HDF4Error
@@ -15,7 +19,14 @@ import h5py
 # Read datasets from hdf4
 #===============================================================================
 class h4_parse(object):
-    '''An interface to parse hdf4 file.
+    '''An interface to parse hdf4 file. The file is opened once and its SD
+    handle kept until close() (or the end of a with block); dataset handles,
+    dataset attributes and global attributes are cached on first access.
+
+    Example:
+    ::
+        with h4_parse(filename) as h4:
+            data = h4.get(['Latitude', 'Longitude'])
 
     Author: yaswant.pradhan
     '''
@@ -24,18 +35,73 @@ class h4_parse(object):
         self.filename = filename
         self.fieldnames = ''
         self.items = []
+        self._h4 = None
+        self._sds = {}
+        self._attrs = {}
+        self._gattrs = None
         self._get_fieldnames()
 
 
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def __del__(self):
+        try:
+            self.close()
+        except HDF4Error:
+            pass
+
+
+    def close(self):
+        '''Release dataset handles and close the hdf file.'''
+        for sds in self._sds.values():
+            sds.endaccess()
+        self._sds = {}
+        if self._h4 is not None:
+            self._h4.end()
+            self._h4 = None
+
+
+    @property
+    def h4(self):
+        '''Open SD interface (opened on first use).'''
+        if self._h4 is None:
+            self._h4 = SD(self.filename, mode=SDC.READ)
+        return self._h4
+
+
+    def select(self, key):
+        '''Return a cached SDS handle for dataset key.'''
+        if key not in self._sds:
+            self._sds[key] = self.h4.select(key)
+        return self._sds[key]
+
+
+    def attributes(self, key=None):
+        '''Return cached attributes of dataset key, or the global attributes
+        if key is None.'''
+        if key is None:
+            if self._gattrs is None:
+                self._gattrs = self.h4.attributes()
+            return self._gattrs
+        if key not in self._attrs:
+            self._attrs[key] = self.select(key).attributes()
+        return self._attrs[key]
+
+
     def _get_fieldnames(self):
         '''Print available datasets in hdf file
         '''
         try:
-            h4 = SD(self.filename, mode=SDC.READ)
-            self.fieldnames = sorted(h4.datasets().keys())
-            for k, v in sorted(h4.datasets().viewitems()):
+            datasets = self.h4.datasets()
+            self.fieldnames = sorted(datasets.keys())
+            for k, v in sorted(datasets.viewitems()):
                 self.items.append((k, v[1]))
-            h4.end()
         except HDF4Error as e:
             print "HDF4Error", e, self.filename
 
@@ -49,35 +115,29 @@ class h4_parse(object):
             'scale_factor'
             'add_offset'
             '_FillValue'
+        All requested fields are read through the one open file handle.
         '''
         if not isinstance(fieldnames, list):
             fieldnames = [fieldnames]
 
         try:
-            # Open hdf4 interface in read mode
-            h4 = SD(self.filename, mode=SDC.READ)
             sclinfo = None
-            if 'Slope_and_Offset_Usage' in h4.attributes():
+            if 'Slope_and_Offset_Usage' in self.attributes():
                 sclinfo = 'Slope_and_Offset_Usage'
 
-
             if len(fieldnames) == 0:
                 # Get all available field names from hdf
-                fieldnames = []
-                for key in sorted(h4.datasets()):
-                    fieldnames.append(key)
-            # Create and empty dataset dictionary with all available
-            # fields fill in data from SDS
-            datasets = dict.fromkeys(fieldnames, {})
-            for key in datasets:
-                attrs = h4.select(key).attributes()
+                fieldnames = list(self.fieldnames)
+            # Create dataset dictionary with all requested fields and fill in
+            # data from SDS
+            datasets = {}
+            for key in fieldnames:
+                attrs = dict(self.attributes(key))
                 if sclinfo:
-                    attrs[sclinfo] = h4.attributes()[sclinfo]
+                    attrs[sclinfo] = self.attributes()[sclinfo]
 
                 datasets[key] = attrs
-                datasets[key]['data'] = h4.select(key).get()
-            # Close hdf interface
-            h4.end()
+                datasets[key]['data'] = self.select(key).get()
         except HDF4Error as e:
             print "HDF4Error", e
             sys.exit(1)
@@ -86,19 +146,74 @@ class h4_parse(object):
         return datasets
 
 
-    def get_scaled(self, fieldnames=[]):
-        temp = self.get(fieldnames)
-        scaled = dict.fromkeys(temp.keys(), None)
-        fillvalue = {}
+    def get_scaled(self, fieldnames=[], out=None, masked=True):
+        '''Returns specific or all SDS in the hdf file scaled to physical
+        values as float32 arrays. Fields are read one at a time and scaled in
+        place, so at most one raw array is held in memory besides the
+        results. The scaling convention follows the global
+        'Slope_and_Offset_Usage' attribute if present, ie
+        scale_factor * (data - add_offset) for MODIS style files, otherwise
+        scale_factor * data + add_offset.
+
+        Kwargs:
+         * fieldnames (list) SDS names to read (def: all)
+         * out (ndarray or dict) preallocated float32 buffer (single field)
+           or {fieldname: buffer} to write scaled values into
+         * masked (bool) return masked arrays with fill values masked;
+           if False fill values are set to NaN (def: True)
+
+        Returns:
+         * dictionary of scaled arrays with '_FillValues' key holding the
+           raw fill value of each field
+        '''
+        if not isinstance(fieldnames, list):
+            fieldnames = [fieldnames]
+        if len(fieldnames) == 0:
+            fieldnames = list(self.fieldnames)
+        if out is not None and not isinstance(out, dict):
+            if len(fieldnames) != 1:
+                raise ValueError('out must be a dict for multiple fields')
+            out = {fieldnames[0]: out}
 
-        for k in scaled:
-            # see h4.attributes()['Slope_and_Offset_Usage']
-            fillvalue[k] = temp[k]['_FillValue']
-            scaled[k] = temp[k]['data'] * \
-                        (temp[k]['scale_factor'] - temp[k]['add_offset'])
+        usage = self.attributes().get('Slope_and_Offset_Usage', '')
+        subtract_offset = '- add_offset' in ' '.join(usage.split())
 
-            w = np.where(temp[k]['data'] == fillvalue[k])
-            scaled[k][w] = fillvalue[k]
+        scaled, fillvalue = {}, {}
+        try:
+            for k in fieldnames:
+                attrs = self.attributes(k)
+                scale = np.float32(attrs.get('scale_factor', 1.0))
+                offset = np.float32(attrs.get('add_offset', 0.0))
+                fillvalue[k] = attrs.get('_FillValue', None)
+                raw = self.select(k).get()
+
+                buf = out.get(k) if out else None
+                if buf is None:
+                    buf = np.empty(raw.shape, dtype=np.float32)
+                elif buf.shape != raw.shape:
+                    raise ValueError('out buffer for %s has shape %s, '
+                                     'expected %s' % (k, buf.shape, raw.shape))
+
+                if subtract_offset:
+                    np.subtract(raw, offset, out=buf, casting='unsafe')
+                    np.multiply(buf, scale, out=buf)
+                else:
+                    np.multiply(raw, scale, out=buf, casting='unsafe')
+                    np.add(buf, offset, out=buf)
+
+                fill = None
+                if fillvalue[k] is not None:
+                    fill = (raw == fillvalue[k])
+                del raw
+
+                if masked:
+                    scaled[k] = np.ma.array(buf, mask=fill, copy=False)
+                else:
+                    if fill is not None: buf[fill] = np.nan
+                    scaled[k] = buf
+        except HDF4Error as e:
+            print "HDF4Error", e
+            sys.exit(1)
 
         # Add FillValues information
         scaled['_FillValues'] = fillvalue
@@ -112,55 +227,166 @@ class h4_parse(object):
 # Read datasets from hdf5
 #===============================================================================
 class h5_parse(object):
+    '''An interface to parse hdf5 file. The dataset index is built once with
+    visititems (and optionally persisted next to the file) and the file is
+    kept open until close() (or the end of a with block).
+
+    Args:
+     * filename (str) HDF5 filename
+
+    Kwargs:
+     * verbose (bool) print file structure while indexing (def: False)
+     * index (bool or str) persist the dataset index as json; True writes
+       <filename>.index.json, a str gives the index path (def: False)
+     * rdcc_nbytes (int) raw data chunk cache size in bytes (def: h5py, 1MB)
+     * rdcc_nslots (int) number of chunk slots in the cache (def: h5py)
+     * rdcc_w0 (float) chunk preemption policy 0-1 (def: h5py)
+
+    Example:
+    ::
+        with h5_parse(h5file, rdcc_nbytes=64 * 1024**2) as h5:
+            x = h5.get('/Model/GM/Stash/16201/ModelData', stride=[2, 2])
+    '''
+
     def __init__(self, filename, **kw):
         self._filename = filename
         self._datasets = []
+        self.index = {}
         self.verbose = kw.get('verbose', False)
+        self._h5 = None
+        self._cache = dict((k, kw[k]) for k in
+                           ('rdcc_nbytes', 'rdcc_nslots', 'rdcc_w0')
+                           if kw.get(k) is not None)
+        self._indexfile = kw.get('index', False)
+        if self._indexfile is True:
+            self._indexfile = filename + '.index.json'
 
-        self.get_fieldnames()
+        if not (self._indexfile and self._load_index()):
+            self.get_fieldnames()
+            if self._indexfile: self._save_index()
 
-    def get_fieldnames(self, verbose=False):
-        h5f = h5py.File(self._filename, mode='r')
-        self.print_h5_struct(h5f)
-        h5f.close()
 
-    def print_h5_struct(self, h5, offset=' '):
-        if isinstance(h5, h5py.File):
-            if self.verbose:
-                print h5.file, '(File)', h5.name
-        elif isinstance(h5, h5py.Group):
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        '''Close the hdf5 file.'''
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+
+    @property
+    def h5(self):
+        '''Open h5py.File (opened on first use with the chunk cache
+        settings given at construction).'''
+        if self._h5 is None:
+            self._h5 = h5py.File(self._filename, mode='r', **self._cache)
+        return self._h5
+
+
+    def _stamp(self):
+        st = os.stat(self._filename)
+        return [st.st_size, int(st.st_mtime)]
+
+
+    def _load_index(self):
+        '''Load a persisted index if it matches the file size and mtime.'''
+        try:
+            with open(self._indexfile) as fp:
+                saved = json.load(fp)
+        except (IOError, OSError, ValueError):
+            return False
+        if saved.get('stamp') != self._stamp(): return False
+        self.index = dict((str(k), (tuple(v[0]), str(v[1]),
+                                    tuple(v[2]) if v[2] else None))
+                          for k, v in saved['datasets'].iteritems())
+        self._datasets = sorted(self.index)
+        return True
+
+
+    def _save_index(self):
+        tmp = '%s.%d.tmp' % (self._indexfile, os.getpid())
+        try:
+            with open(tmp, 'w') as fp:
+                json.dump({'stamp': self._stamp(), 'datasets': self.index}, fp)
+            os.rename(tmp, self._indexfile)
+        except (IOError, OSError) as e:
+            if self.verbose: print 'Index not saved:', e
+
+
+    def get_fieldnames(self, verbose=False):
+        '''(Re)build the dataset index from the file.'''
+        self._datasets = []
+        self.index = {}
+        if self.verbose:
+            print self.h5.file, '(File)', self.h5.name
+        self.h5.visititems(self.print_h5_struct)
+        self._datasets.sort()
+
+
+    def print_h5_struct(self, name, obj):
+        '''visititems callback: record datasets and optionally print.'''
+        name = '/' + str(name)
+        if isinstance(obj, h5py.Dataset):
+            self._datasets.append(name)
+            self.index[name] = (obj.shape, obj.dtype.str, obj.chunks)
             if self.verbose:
-                print '(Group)', h5.name
-        elif isinstance(h5, h5py.Dataset):
-            self._datasets.append(h5.name)
+                print '(Dataset)', name, 'len =', obj.shape
+        elif isinstance(obj, h5py.Group):
             if self.verbose:
-                print '(Dataset)', h5.name, 'len =', h5.shape
-        else:
-            print 'WARNING: Unknown item in HDF5 file', h5.name
-            sys.exit ("Execution terminated.")
+                print '(Group)', name
+        elif self.verbose:
+            print 'WARNING: Unknown item in HDF5 file', name
+
 
-        if isinstance(h5, h5py.File) or isinstance(h5, h5py.Group):
-            for key, val in dict(h5).iteritems():
-                if self.verbose: print offset, key,
-                self.print_h5_struct(val, offset + ' ')
+    def dataset(self, dsetname):
+        '''Return the h5py.Dataset for arbitrary numpy style slicing.'''
+        return self.h5[dsetname]
 
-    def get(self, dsetname):
-        h5f = h5py.File(self._filename, mode='r')
-        dataset = h5f[dsetname][:]
-        h5f.close()
-        return dataset
+
+    def get(self, dsetname, start=None, stop=None, stride=None):
+        '''Read a dataset or a strided slab of it from the open file.
+
+        Args:
+         * dsetname (str) full dataset path (see self._datasets)
+
+        Kwargs:
+         * start (list) start index per dimension (def: 0)
+         * stop (list) stop index per dimension, None for end (def: None)
+         * stride (list) step per dimension (def: 1)
+
+        Returns:
+         * numpy array of the selected region
+        '''
+        dset = self.h5[dsetname]
+        if start is None and stop is None and stride is None:
+            return dset[()]
+        n = dset.ndim
+        start = start or [0] * n
+        stop = stop or [None] * n
+        stride = stride or [1] * n
+        sel = tuple(slice(start[i], stop[i], stride[i]) for i in range(n))
+        return dset[sel]
 
 
 #===============================================================================
 # Get a scientific dataset(s) from an HDF4 file
 #===============================================================================
-def get_sd(FILENAME=None, SDSNAME=None, QUIET=False):
+def get_sd(FILENAME=None, SDSNAME=None, QUIET=False, LAZY=False):
     '''Return SDS object(s) from HDF4 file
 
     Kwargs:
      * FILENAME (str) Input filename
      * SDSNAME (list) List of fields to read in
      * QUIET (bool) Silent all information
+     * LAZY (bool) Return sds_array proxies that read only the indexed
+       values (see sds_array)
 
     Returns:
      * SDS object or list of objects where object.get() method returns a numpy ndarray
@@ -196,7 +422,8 @@ def get_sd(FILENAME=None, SDSNAME=None, QUIET=False):
         sds = []
         for idx, val in enumerate(DATAFIELD_NAME):
             if (QUIET is False): print "Reading {0} {1} ..".format(idx, val)
-            sds.append(hdf4.select(val))
+            sds.append(sds_array(hdf4.select(val)) if LAZY is True
+                       else hdf4.select(val))
             # print sds.info()
 
         # Return SDS object instead of list if only one dataset is requested
@@ -209,10 +436,170 @@ def get_sd(FILENAME=None, SDSNAME=None, QUIET=False):
 
 
 
+#===============================================================================
+# Read a hyperslab from an HDF4 scientific dataset
+#===============================================================================
+def read_sd(sds, start=None, count=None, stride=None):
+    '''Read a hyperslab (start/count/stride selection) from an HDF4 SDS
+    object, so that only the selected plane or window is read from disk.
+
+    Args:
+     * sds (SDS) pyhdf SDS object, eg as returned by get_sd()
+
+    Kwargs:
+     * start (list) Start index per dimension (def: 0)
+     * count (list) Number of values per dimension; None reads to the end
+       of that dimension (def: all)
+     * stride (list) Step per dimension (def: 1)
+
+    Returns:
+     * numpy ndarray of the selection (rank is preserved, use count=1 and
+       index the result to drop a dimension)
+
+    Example:
+    ::
+        qa = get_sd(FILENAME=f, SDSNAME='Quality_Assurance_Land', QUIET=True)
+        qa5 = read_sd(qa, start=[0, 0, 4], count=[None, None, 1])[:, :, 0]
+    '''
+    dims = sds.info()[2]
+    if not isinstance(dims, list): dims = [dims]
+    rank = len(dims)
+    start = [0] * rank if start is None else list(start)
+    stride = [1] * rank if stride is None else list(stride)
+    count = [None] * rank if count is None else list(count)
+    for i in range(rank):
+        if count[i] is None:
+            count[i] = (dims[i] - start[i] + stride[i] - 1) // stride[i]
+    return sds.get(start=start, count=count, stride=stride)
+
+
+#===============================================================================
+# Lazy array proxy for an HDF4 scientific dataset
+#===============================================================================
+_SDC_DTYPES = {SDC.CHAR8: 'S1', SDC.UCHAR8: 'u1', SDC.INT8: 'i1',
+               SDC.UINT8: 'u1', SDC.INT16: 'i2', SDC.UINT16: 'u2',
+               SDC.INT32: 'i4', SDC.UINT32: 'u4', SDC.FLOAT32: 'f4',
+               SDC.FLOAT64: 'f8'}
+
+
+class sds_array(object):
+    '''Lazy, sliceable proxy for an HDF4 SDS. NumPy style indexing with
+    integers, slices and Ellipsis is translated into a hyperslab read (see
+    read_sd), so only the selected values are read from disk. Index arrays
+    and masks are applied after reading the full extent of that dimension;
+    an N-d boolean mask (eg lon[aod > fill]) reads the whole SDS.
+    Other SDS methods and attributes (get, getfillvalue, info, ...) are
+    passed through to the wrapped object.
+
+    Args:
+     * sds (SDS) pyhdf SDS object
+
+    Kwargs:
+     * scaled (bool) Indexing returns scale_factor * data + add_offset as a
+       float32 masked array with fill values masked (def: False ie raw)
+
+    Attributes:
+     * name, shape, ndim, size, dtype (raw), scale_factor, add_offset,
+       fill_value, valid_range
+    '''
+
+    def __init__(self, sds, scaled=False):
+        self.sds = sds
+        self.scaled = scaled
+        info = sds.info()
+        dims = info[2] if isinstance(info[2], list) else [info[2]]
+        self.name = info[0]
+        self.shape = tuple(dims)
+        self.ndim = len(dims)
+        self.size = int(np.prod(dims))
+        self.dtype = np.dtype(_SDC_DTYPES.get(info[3], 'f8'))
+        attrs = sds.attributes()
+        self.scale_factor = attrs.get('scale_factor', 1.0)
+        self.add_offset = attrs.get('add_offset', 0.0)
+        self.fill_value = attrs.get('_FillValue', None)
+        self.valid_range = attrs.get('valid_range', None)
+
+
+    def __getattr__(self, name):
+        if name == 'sds': raise AttributeError(name)
+        return getattr(self.sds, name)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+
+    def __getitem__(self, key):
+        if isinstance(key, np.ndarray) and key.dtype == np.bool_ and \
+           key.ndim > 1:
+            # N-d mask spans several dimensions: read all, then select
+            if key.shape != self.shape[:key.ndim]:
+                raise IndexError('mask shape %s does not match %s %s' %
+                                 (key.shape, self.name, self.shape))
+            return self[...][key]
+        if not isinstance(key, tuple): key = (key,)
+        if Ellipsis in [k for k in key if not isinstance(k, np.ndarray)]:
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + \
+                  key[i + 1:]
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for ' + self.name)
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        start, count, stride, post = [], [], [], []
+        for k, n in zip(key, self.shape):
+            if isinstance(k, (int, long, np.integer)):
+                k = int(k) + n if k < 0 else int(k)
+                if not 0 <= k < n:
+                    raise IndexError('index out of range for ' + self.name)
+                start.append(k)
+                count.append(1)
+                stride.append(1)
+                post.append(0)
+            elif isinstance(k, slice):
+                b, e, st = k.indices(n)
+                m = len(xrange(b, e, st))
+                if st < 0:
+                    # read forward and reverse afterwards
+                    b, st = b + (m - 1) * st, -st
+                    post.append(slice(None, None, -1))
+                else:
+                    post.append(slice(None))
+                start.append(b if m > 0 else 0)
+                count.append(m)
+                stride.append(st)
+            else:
+                start.append(0)
+                count.append(n)
+                stride.append(1)
+                post.append(np.asarray(k))
+
+        if 0 in count:
+            data = np.empty(count, dtype=self.dtype)
+        else:
+            data = self.sds.get(start=start, count=count, stride=stride)
+        data = data[tuple(post)]
+        return self._scale(data) if self.scaled is True else data
+
+
+    def _scale(self, data):
+        '''Apply scale_factor/add_offset to raw values and mask fills.'''
+        out = np.asarray(data, dtype=np.float32) * \
+            np.float32(self.scale_factor) + np.float32(self.add_offset)
+        if self.fill_value is None: return np.ma.array(out)
+        return np.ma.masked_where(np.asarray(data) == self.fill_value, out)
+
+
 #===============================================================================
 # Get a specific dataset from an HDF5 file
 #===============================================================================
-def get_h5(filename, dataset, start=[0, 0], stop=[None, None], stride=[1, 1]):
+def get_h5(filename, dataset, start=[0, 0], stop=[None, None], stride=[1, 1],
+           out=None, fields=None, mmap=False):
     '''
     Read a 2D dataset from HDF5 file
 
@@ -224,28 +611,75 @@ def get_h5(filename, dataset, start=[0, 0], stop=[None, None], stride=[1, 1]):
      * start (list) [x0, y0] starting position if a sub-region is required
      * stop (list) [x0, y0] ending position if a sub-region is required
      * stride (list) [xn, yn] number of pixels to skip while returning the dataset
+     * out (ndarray) preallocated array of the selected shape to read into;
+       chunked datasets are read one row of chunks at a time
+     * fields (str or list) field name(s) to select from a compound dataset
+     * mmap (bool) return a read-only memory-mapped view (no copy) when the
+       dataset is stored contiguous and uncompressed; ignored otherwise
 
     Returns:
-     * 2D numpy array of specified dataset (or a sliced region see Kwargs)
+     * 2D numpy array of specified dataset (or a sliced region see Kwargs);
+       out if given, a numpy.memmap view for mmap, else a masked array
     '''
 
     print("Reading " + dataset + '..')
-    f = h5py.File(filename, 'r')
-    group = f['/']
-    #
-    # For compound (structured) dataset the slicing approach wont work as is
-    # TODO: think of a clever way to deal with that, eg,
-    #      data = group[dataset] and then apply slicing?
-    #
-    if not stop[0] or not stop[1]:
-        data = np.ma.array(group[dataset][start[0]::stride[0],
-                                          start[1]::stride[1]])
-    else:
-        data = np.ma.array(group[dataset][start[0]:stop[0]:stride[0],
-                                          start[1]:stop[1]:stride[1]])
-
-    f.close()
-    return data
+    if isinstance(fields, basestring): fields = [fields]
+    with h5py.File(filename, 'r') as f:
+        dset = f['/'][dataset]
+        sel = tuple(slice(start[i], stop[i] or None, stride[i])
+                    for i in range(len(start)))
+
+        if mmap and dset.chunks is None and dset.compression is None and \
+                (fields is None or len(fields) == 1):
+            offset = dset.id.get_offset()
+            if offset is not None:
+                data = np.memmap(filename, mode='r', dtype=dset.dtype,
+                                 offset=offset, shape=dset.shape)
+                if fields: data = data[fields[0]]
+                return data[sel]
+
+        if fields:
+            # h5py reads compound members given as extra string indices
+            data = dset[tuple(fields) + sel]
+            if out is None: return np.ma.array(data, copy=False)
+            out[...] = data
+            return out
+
+        if out is None:
+            shape = tuple(len(xrange(*s.indices(n)))
+                          for s, n in zip(sel, dset.shape))
+            shape += dset.shape[len(sel):]
+            if 0 in shape: return np.ma.array(np.empty(shape, dset.dtype))
+            data = np.ma.array(np.empty(shape, dset.dtype), copy=False)
+            _read_h5_chunks(dset, sel, data.data)
+            return data
+
+        _read_h5_chunks(dset, sel, out)
+        return out
+
+
+def _read_h5_chunks(dset, sel, out):
+    '''Read dset[sel] into out. For chunked datasets the read is split
+    along the first dimension at chunk boundaries so each chunk is
+    decompressed once and the chunk cache only needs one row of chunks.'''
+    if out.size == 0: return
+    step0 = sel[0].indices(dset.shape[0])[2]
+    if dset.chunks is None or step0 < 0:
+        dset.read_direct(out, source_sel=sel)
+        return
+
+    first, stop, step = sel[0].indices(dset.shape[0])
+    c0 = dset.chunks[0]
+    i = 0
+    for b in xrange(first - first % c0, stop, c0):
+        lo = max(b, first)
+        lo = first + -(-(lo - first) // step) * step
+        hi = min(b + c0, stop)
+        if lo >= hi: continue
+        nrow = len(xrange(lo, hi, step))
+        dset.read_direct(out, source_sel=(slice(lo, hi, step),) + sel[1:],
+                         dest_sel=np.s_[i:i + nrow])
+        i += nrow
 
 
 
@@ -259,14 +693,180 @@ def get_nc(filename, dataset, verb=False):
 
 
 def get_nc4(filename, dataset):
+    '''Read a netCDF4 variable. dataset may be a group path (eg
+    'Data/MeasurementData/GeoData/aerosol_center_longitude'). If filename is
+    a list or glob pattern the variable is concatenated along its first
+    dimension across the files (see nc_aggregate).'''
     from netCDF4 import Dataset
     print("Reading " + dataset + '..')
+    if not isinstance(filename, basestring) or glob.has_magic(filename):
+        return nc_aggregate(filename, dataset)[:]
     with Dataset(filename, 'r') as f:
         # Dataset is the class behaviour to open the
         # file and create an instance of the ncCDF4
         # class
-        data = f.variables[dataset]    
-        return data[:]    
+        data = _nc_variable(f, dataset)
+        return data[:]
+
+
+def _nc_variable(nc, path):
+    '''Return variable at a (possibly nested) group path in an open
+    netCDF4 Dataset.'''
+    names = [p for p in path.split('/') if p]
+    grp = nc
+    for name in names[:-1]:
+        grp = grp.groups[name]
+    return grp.variables[names[-1]]
+
+
+# Serialise netCDF library calls across threads (see nc_aggregate)
+_NC_LOCK = threading.Lock()
+
+
+#===============================================================================
+# Read a variable aggregated over many netCDF files
+#===============================================================================
+class nc_aggregate(object):
+    '''Virtual concatenation of one netCDF variable across many files
+    along a dimension. Only the file shapes are read on construction;
+    indexing reads the selected slab from each contributing file, so
+    daily/granule files can be sliced without loading them all.
+
+    Args:
+     * files (str or list) glob pattern or list of netCDF filenames; files
+       are used in the given (or sorted glob) order
+     * variable (str) variable name or group path, eg
+       'Data/MeasurementData/ObservationData/Aerosol/aerosol_optical_depth'
+
+    Kwargs:
+     * dim (int) dimension to concatenate along (def: 0)
+     * threads (int) number of threads reading files concurrently (def: 1).
+       Has no effect with the default lock=True: files are then still
+       opened and read one at a time
+     * lock (bool) serialise netCDF library calls through a single global
+       lock, as netCDF-C is not thread-safe by default; set False only with
+       a thread-safe netCDF-C/HDF5 build to let reads overlap (def: True)
+
+    Attributes:
+     * files, shape, ndim, dtype, counts (length of each file along dim)
+
+    Example:
+    ::
+        aod = nc_aggregate('/data/pmap/2016/*/*.nc', 'Data/MeasurementData/'
+                           'ObservationData/Aerosol/aerosol_optical_depth')
+        last_day = aod[-1000:]
+    '''
+
+    def __init__(self, files, variable, dim=0, threads=1, lock=True):
+        if isinstance(files, basestring): files = sorted(glob.glob(files))
+        if len(files) == 0:
+            raise IOError('No netCDF files to aggregate')
+        self.files = list(files)
+        self.variable = variable
+        self.dim = dim
+        self.threads = threads
+        self._lock = _NC_LOCK if lock else None
+
+        info = self._map(self._info, self.files)
+        shape, self.dtype = info[0]
+        for fi, (s, _) in zip(self.files, info):
+            if s[:dim] + s[dim + 1:] != shape[:dim] + shape[dim + 1:]:
+                raise ValueError('%s: %s has shape %s, expected %s along '
+                                 'non-concatenated dimensions' %
+                                 (fi, variable, s, shape))
+        self.counts = np.array([s[dim] for s, _ in info], dtype=np.int64)
+        self._offsets = np.concatenate(([0], np.cumsum(self.counts)))
+        self.shape = shape[:dim] + (int(self._offsets[-1]),) + \
+            shape[dim + 1:]
+        self.ndim = len(self.shape)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+
+    def _open(self, filename, func):
+        from netCDF4 import Dataset
+        if self._lock: self._lock.acquire()
+        try:
+            with Dataset(filename, 'r') as f:
+                return func(_nc_variable(f, self.variable))
+        finally:
+            if self._lock: self._lock.release()
+
+
+    def _info(self, filename):
+        return self._open(filename, lambda v: (v.shape, v.dtype))
+
+
+    def _map(self, func, items):
+        if self.threads > 1 and len(items) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.threads, len(items)))
+            try:
+                return pool.map(func, items)
+            finally:
+                pool.close()
+        return map(func, items)
+
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple): key = (key,)
+        if Ellipsis in [k for k in key if not isinstance(k, np.ndarray)]:
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + \
+                key[i + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) > self.ndim:
+            raise IndexError('too many indices for %d-d variable' % self.ndim)
+
+        # global indices along the aggregated dimension
+        k = key[self.dim]
+        squeeze = isinstance(k, (int, long, np.integer))
+        index = np.arange(self.shape[self.dim])[k]
+        index = np.atleast_1d(index)
+        # axis of the aggregated dimension in the result
+        axis = self.dim - sum(isinstance(x, (int, long, np.integer))
+                              for x in key[:self.dim])
+
+        ifile = np.searchsorted(self._offsets, index, side='right') - 1
+        # split into runs of consecutive indices from the same file, so the
+        # requested order is preserved
+        brk = np.flatnonzero(np.diff(ifile)) + 1
+        jobs = []
+        for run in np.split(np.arange(index.size), brk):
+            if run.size == 0: continue
+            f = ifile[run[0]]
+            jobs.append((f, index[run] - self._offsets[f]))
+
+        def read(job):
+            f, local = job
+            lo, hi = local.min(), local.max() + 1
+            step = local[1] - local[0] if local.size > 1 else 1
+            if step > 0 and np.all(np.diff(local) == step):
+                sel = slice(lo, hi, step)
+                take = None
+            else:
+                sel = slice(lo, hi)
+                take = local - lo
+            sub = key[:self.dim] + (sel,) + key[self.dim + 1:]
+            data = self._open(self.files[f], lambda v: v[sub])
+            if take is not None: data = np.ma.take(data, take, axis=axis)
+            return data
+
+        if len(jobs) == 0:
+            shape = np.broadcast_to(False, self.shape)[key].shape
+            return np.ma.empty(shape, dtype=self.dtype)
+        parts = self._map(read, jobs)
+        data = parts[0] if len(parts) == 1 else \
+            np.ma.concatenate(parts, axis=axis)
+        if squeeze: data = np.ma.squeeze(data, axis=axis)
+        return data
 
 
 #===============================================================================
@@ -281,14 +881,12 @@ def plot_sd(SD):
     name = SD.info()[0]
     rank = SD.info()[1]
     dims = SD.info()[2]
+    lazy = SD if isinstance(SD, sds_array) else sds_array(SD)
 
     fill = SD._FillValue
     scale = SD.scale_factor
     offset = SD.add_offset
 #     unit = SD.units
-    data = SD.get()
-    # print data.shape, rank
-    scl_data = data * scale + offset
     vrng = np.array(SD.valid_range) * scale + offset
 
 
@@ -299,14 +897,17 @@ def plot_sd(SD):
         gs = gridspec.GridSpec(nr, nc)
 
         for i in range(0, dims[0]):
-            if data[i, :, :].max() == fill: continue
+            # Read one plane at a time rather than the whole cube
+            data = lazy[i]
+            if data.max() == fill: continue
+            scl_data = data * scale + offset
 
             ax = fig.add_subplot(gs[i])
             frame = plt.gca()
             frame.axes.get_xaxis().set_ticks([])
             frame.axes.get_yaxis().set_ticks([])
             ax.set_title('{0}:{1}'.format(name, i + 1), fontsize=10)
-            mdata = np.ma.masked_where(data[i, :, :] == fill, scl_data[i, :, :])
+            mdata = np.ma.masked_where(data == fill, scl_data)
 #             print 'Reading array', i
 #             print mdata.min(), mdata.max(), mdata.ptp()
             vrng = [mdata.min(), mdata.max()]
@@ -321,6 +922,8 @@ def plot_sd(SD):
 
 
     elif rank == 2:
+        data = SD.get()
+        scl_data = data * scale + offset
         if data.max() == fill:
             # No valid sds in the selected field, skip further processing..
             raise SystemExit('** W: No valid data in {0} for '\
@@ -8,20 +8,33 @@ Created on 05 Feb 2016.
 '''
 import base64
 import csv
+import ftplib
 import glob
+import hashlib
+import json
 import numpy as np
 import os
 import re
+import sqlite3
 import sys
+import threading
+import time
+from collections import deque
 from contextlib import closing
+from multiprocessing import Pool
 from datetime import datetime as dt, \
                      timedelta as td
+from Queue import Queue, Empty
 from shutil import copyfileobj
+from urllib import unquote
 from urllib2 import urlopen, \
                     Request, \
+                    HTTPError, \
                     URLError
+from urlparse import urlparse
 from ypylib.hdf import get_sd
 from ypylib.stat import bin_xyz
+from ypylib.utils import tai93_to_datetime64, write_parquet
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 from mpl_toolkits.basemap import Basemap
@@ -37,6 +50,676 @@ LatoB = fm.FontProperties(fname=Lato[0])
 LatoR = fm.FontProperties(fname=Lato[1])
 
 
+#===============================================================================
+# Pool of persistent FTP control connections
+#===============================================================================
+class FTPPool(object):
+    '''Logged-in FTP sessions kept open and reused for directory listings
+    and RETR transfers to the same server. Sessions are keyed by host, port
+    and user, handed out to one thread at a time, and replaced by a fresh
+    login when a command fails on a stale connection.
+
+    Kwargs:
+     * timeout (real) Socket timeout in seconds (def: 60)
+    '''
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.logins = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+
+    def _key(self, url):
+        url = urlparse(url) if isinstance(url, basestring) else url
+        return (url.hostname, url.port or 21,
+                unquote(url.username or 'anonymous'),
+                unquote(url.password or ''))
+
+
+    def acquire(self, url):
+        '''Return an idle session for the url server, or log in a new one.'''
+        key = self._key(url)
+        with self._lock:
+            idle = self._idle.get(key, [])
+            if len(idle) > 0: return idle.pop()
+
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(key[0], key[1])
+        ftp.login(key[2], key[3])
+        with self._lock:
+            self.logins += 1
+        return ftp
+
+
+    def release(self, url, ftp):
+        '''Return a session to the pool for reuse.'''
+        with self._lock:
+            self._idle.setdefault(self._key(url), []).append(ftp)
+
+
+    def run(self, url, func, retries=1):
+        '''Call func(ftp) with a pooled session for url. A session that fails
+        with anything but a permanent (5xx) reply is closed and func is
+        retried on a new login, so func must be safe to repeat.
+        '''
+        for attempt in range(retries + 1):
+            ftp = self.acquire(url)
+            try:
+                result = func(ftp)
+            except ftplib.error_perm:
+                self.release(url, ftp)
+                raise
+            except ftplib.all_errors:
+                ftp.close()
+                if attempt == retries: raise
+            else:
+                self.release(url, ftp)
+                return result
+
+
+    def close(self):
+        '''Log out all idle sessions.'''
+        with self._lock:
+            sessions = [f for idle in self._idle.values() for f in idle]
+            self._idle = {}
+        for ftp in sessions:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+#===============================================================================
+# Transfer a single remote file to local disk
+#===============================================================================
+def _transfer(remote, part, pool=None):
+    '''Append remote url content to a partial file, resuming from its current
+    size. FTP transfers are resumed with REST and HTTP transfers with a Range
+    request; other schemes (eg file://) always restart from the beginning.
+
+    Args:
+     * remote (str) Source url
+     * part (str) Partial destination filename
+
+    Kwargs:
+     * pool (FTPPool) Session pool for ftp urls (def: one-off session)
+
+    Returns:
+     * remote file size in bytes (int) or None if the server does not tell
+    '''
+    url = urlparse(remote)
+    if url.scheme == 'ftp':
+        path = unquote(url.path)
+
+        def retr(ftp):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            ftp.voidcmd('TYPE I')  # SIZE is refused after an ascii LIST
+            size = ftp.size(path)
+            if size is not None and offset > size: offset = 0
+            if size is not None and offset == size: return size
+            with open(part, 'ab' if offset > 0 else 'wb') as f:
+                ftp.retrbinary('RETR ' + path, f.write,
+                               rest=offset if offset > 0 else None)
+            return size
+
+        if pool is not None: return pool.run(url, retr)
+        pool = FTPPool()
+        try:
+            return pool.run(url, retr, retries=0)
+        finally:
+            pool.close()
+
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    req = Request(remote)
+    if offset > 0 and url.scheme in ('http', 'https'):
+        req.add_header('Range', 'bytes={}-'.format(offset))
+    try:
+        r = urlopen(req)
+    except HTTPError as e:
+        if e.code != 416: raise
+        # Range not satisfiable: partial file is stale, start over
+        os.remove(part)
+        return _transfer(remote, part)
+
+    with closing(r):
+        crange = r.info().getheader('Content-Range')
+        clen = r.info().getheader('Content-Length')
+        if r.getcode() == 206 and crange:
+            size, mode = int(crange.split('/')[-1]), 'ab'
+        else:
+            size, mode = (int(clen) if clen else None), 'wb'
+        with open(part, mode) as f:
+            copyfileobj(r, f)
+    return size
+
+
+def _fetch(remote, local, retries=3, pool=None):
+    '''Download a remote (ftp/http/file) url to a local file.
+    Data are written to "local.part", resumed from its current size on retry,
+    verified against the remote size and atomically renamed to local, so an
+    interrupted transfer never leaves a truncated file under the final name.
+
+    Args:
+     * remote (str) Source url
+     * local (str) Destination filename
+
+    Kwargs:
+     * retries (int) Number of resume attempts after a failed transfer
+     * pool (FTPPool) Session pool for ftp urls
+
+    Returns:
+     * number of bytes transferred (int)
+    '''
+    part = local + '.part'
+    start = os.path.getsize(part) if os.path.exists(part) else 0
+    for attempt in range(retries + 1):
+        try:
+            size = _transfer(remote, part, pool=pool)
+            got = os.path.getsize(part)
+            if size is not None and got != size:
+                if got > size: os.remove(part)
+                raise IOError('Size mismatch {0} ({1} of {2} bytes)'.format(
+                    os.path.basename(local), got, size))
+            break
+        except ftplib.error_perm:
+            raise
+        except ftplib.all_errors as e:
+            if attempt == retries: raise
+            print ' ** Retrying ' + os.path.basename(local) + ': ' + str(e)
+
+    os.rename(part, local)
+    return got - min(start, got)
+
+
+#===============================================================================
+# Read valid AOD samples from one level-2 swath file
+#===============================================================================
+def _read_granule(hdfi, collection, aodfields):
+    '''Read valid AOD samples from a single Level-2 swath file. This is a
+    module level function so that it can run in a multiprocessing pool.
+
+    Args:
+     * hdfi (str) Level 2 MODIS hdf filename
+     * collection (int) MODIS collection (5 or 6)
+     * aodfields (list) SDS names, see Level2Files
+
+    Returns:
+     * 1D arrays of: scan_time (float64), longitude, latitude,
+       aod550 (float32) and quality_indicator (int16)
+    '''
+    try:
+        sds = get_sd(FILENAME=hdfi, SDSNAME=aodfields, QUIET=True, LAZY=True)
+    except SystemExit:
+        # get_sd exits on HDF4Error, which would kill a pool worker
+        raise IOError('Failed to read ' + hdfi)
+
+    if collection == 6:
+        lon, lat, time, aodc, qf = sds
+        aod = aodc[:]
+    else:
+        lon, lat, time, aodc, aodd, qf = sds
+        # Combine DeepBlue and LandOcean AODs
+        aod = aodc[:]
+        t = np.where(aod == aodc.getfillvalue())
+        if len(t[0]) > 0:
+            aod[t] = aodd[:][t]
+
+    fill = aodc.getfillvalue()
+    scale = aodc.scale_factor
+    offset = aodc.add_offset
+    w = np.where(aod > fill)
+    if len(w[0]) == 0:
+        return tuple(np.empty(0, dtype=d) for d in
+                     (np.float64, np.float32, np.float32, np.float32,
+                      np.int16))
+
+    # Only read the rows spanning valid retrievals
+    r0, r1 = w[0].min(), w[0].max() + 1
+    iw = (w[0] - r0, w[1])
+    # Scan_Start_Time is replicated across the swath, but may be fill for
+    # some pixels: use the latest valid time of the row for those
+    tt = time[r0:r1]
+    vtime = tt[iw]
+    tfill = -999. if time.fill_value is None else time.fill_value
+    bad = vtime == tfill
+    if bad.any():
+        rowtime = np.ma.masked_equal(tt, tfill).max(axis=1).filled(tfill)
+        vtime[bad] = rowtime[iw[0][bad]]
+    if collection == 6:
+        vqf = qf[r0:r1][iw]
+    else:
+        # Read only the 5th QA byte plane instead of the whole 3-D array
+        vqf = qf[r0:r1, :, 4][iw]
+
+    return (vtime.astype(np.float64, copy=False),
+            lon[r0:r1][iw].astype(np.float32, copy=False),
+            lat[r0:r1][iw].astype(np.float32, copy=False),
+            (np.float32(scale) * aod[w] +
+             np.float32(offset)).astype(np.float32, copy=False),
+            vqf.astype(np.int16, copy=False))
+
+
+#===============================================================================
+# Cache of per-granule extracted arrays
+#===============================================================================
+_GRANULE_FIELDS = ('scan_time', 'lon', 'lat', 'aod550', 'quality_flag')
+
+
+def _cached_read_granule(hdfi, collection, aodfields, cachedir=None):
+    '''_read_granule() through an on-disk cache of extracted arrays.
+    Entries are .npz files keyed by granule name, size, mtime, collection
+    and aodfields, so a changed or replaced granule, or a different field
+    selection, is decoded again; stale entries for the same granule are
+    removed.
+
+    Args:
+     * hdfi (str) Level 2 MODIS hdf filename
+     * collection (int) MODIS collection (5 or 6)
+     * aodfields (list) SDS names, see Level2Files
+
+    Kwargs:
+     * cachedir (str) Cache directory (def: None ie no caching)
+
+    Returns:
+     * see _read_granule()
+    '''
+    if cachedir is None: return _read_granule(hdfi, collection, aodfields)
+
+    st = os.stat(hdfi)
+    base = os.path.basename(hdfi)
+    key = hashlib.sha1('|'.join([base, str(st.st_size), repr(st.st_mtime),
+                                 str(collection)] + list(aodfields)))
+    entry = os.path.join(cachedir, base + '.' + key.hexdigest()[:16] + '.npz')
+
+    if os.path.exists(entry):
+        try:
+            with np.load(entry) as z:
+                arrays = tuple(z[k] for k in _GRANULE_FIELDS)
+            os.utime(entry, None)  # mark as recently used
+            return arrays
+        except (IOError, KeyError, ValueError):
+            pass  # unreadable entry, decode again
+
+    arrays = _read_granule(hdfi, collection, aodfields)
+    for old in glob.glob(os.path.join(cachedir, base + '.*.npz')):
+        os.remove(old)
+    tmp = entry + '.{0}.part'.format(os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez(f, **dict(zip(_GRANULE_FIELDS, arrays)))
+    os.rename(tmp, entry)
+    return arrays
+
+
+def _evict_cache(cachedir, maxbytes):
+    '''Delete least recently used granule cache entries until the cache
+    directory holds at most maxbytes.
+    '''
+    entries = []
+    for fi in glob.glob(os.path.join(cachedir, '*.npz')):
+        st = os.stat(fi)
+        entries.append((st.st_mtime, st.st_size, fi))
+    total = sum(e[1] for e in entries)
+    for _, size, fi in sorted(entries):
+        if total <= maxbytes: break
+        os.remove(fi)
+        total -= size
+
+
+#===============================================================================
+# Bulk csv export of one granule
+#===============================================================================
+_CSV_BLOCK = 100000
+
+
+def _write_csv_aod(hdfile, csvfile, collection, aodfields, cachedir=None,
+                   deletehdf=False, compress=False):
+    '''Write valid AOD samples of one Level-2 granule to a csv file
+    (Longitude, Latitude, Scan_Start_Time, AOD, QA). Columns are
+    converted and formatted as arrays and rows written in blocks of
+    _CSV_BLOCK. Module level so that it can run in a multiprocessing pool.
+
+    Args:
+     * hdfile (str) Level 2 MODIS hdf filename
+     * csvfile (str) Output csv filename
+     * collection (int) MODIS collection (5 or 6)
+     * aodfields (list) SDS names, see Level2Files
+
+    Kwargs:
+     * cachedir (str) granule cache directory, see Level2Files
+     * deletehdf (bool) Remove hdf file after csv write
+     * compress (bool) Write a gzip stream
+
+    Returns:
+     * number of rows written (0 if no valid retrievals, no file written)
+    '''
+    import gzip
+    vtime, vlon, vlat, vaod, vqf = _cached_read_granule(hdfile, collection,
+                                                        aodfields, cachedir)
+    if vaod.size == 0:
+        print ' ** Not enough valid AOD retrievals **'
+        if (deletehdf is True): os.remove(hdfile)
+        return 0
+
+    # Scan_Start_Time is TAI93 seconds; write UTC as str(datetime) did,
+    # ie without the fraction when it is zero
+    stamp = np.datetime_as_string(tai93_to_datetime64(vtime).astype('M8[us]'))
+    stamp = np.char.replace(np.char.replace(stamp, 'T', ' '), '.000000', '')
+
+    header = aodfields[:4] + aodfields[-1:]
+    tmp = '%s.%d.tmp' % (csvfile, os.getpid())
+    print ' Writing ' + csvfile
+    fo = gzip.open(tmp, 'wb') if compress else open(tmp, 'wb', 1 << 20)
+    try:
+        fo.write(','.join(header) + '\n')
+        for i in xrange(0, vaod.size, _CSV_BLOCK):
+            j = min(i + _CSV_BLOCK, vaod.size)
+            # Format column-wise; astype(str) gives the shortest repr of
+            # each number, as the csv module did. AOD is rounded to drop
+            # float32 scaling noise (eg 0.40500003)
+            cols = (vlon[i:j].astype(str), vlat[i:j].astype(str),
+                    stamp[i:j], np.round(vaod[i:j], 4).astype(str),
+                    vqf[i:j].astype(str))
+            fo.write('\n'.join(map(','.join, zip(*[c.tolist()
+                                                   for c in cols]))) + '\n')
+    finally:
+        fo.close()
+    os.rename(tmp, csvfile)
+    if (deletehdf is True): os.remove(hdfile)
+    return vaod.size
+
+
+def _write_csv_job(job):
+    return _write_csv_aod(*job[0], **job[1])
+
+
+#===============================================================================
+# Granule footprints from MODIS geolocation metadata (geoMeta) files
+#===============================================================================
+def _read_geometa(source):
+    '''Read granule bounding boxes from a MODIS geoMeta text file, eg
+    ladsweb geoMeta/6/AQUA/YYYY/MYD03_YYYY-mm-dd.txt.
+
+    Args:
+     * source (str) Local filename or url of the geoMeta file
+
+    Returns:
+     * dictionary of 'Ayyyyjjj.HHMM' -> (west, east, south, north)
+    '''
+    if os.path.exists(source):
+        with open(source) as f:
+            lines = f.readlines()
+    else:
+        with closing(urlopen(source)) as r:
+            lines = r.readlines()
+
+    header = [i for i, l in enumerate(lines) if 'GranuleID' in l][0]
+    fields = lines[header].lstrip('# ').strip().split(',')
+    footprints = {}
+    for row in csv.DictReader(lines[header + 1:], fieldnames=fields):
+        if row['GranuleID'] is None or row['GranuleID'].startswith('#'):
+            continue
+        key = '.'.join(row['GranuleID'].split('.')[1:3])
+        footprints[key] = tuple(float(row[k]) for k in
+                                ('WestBoundingCoord', 'EastBoundingCoord',
+                                 'SouthBoundingCoord', 'NorthBoundingCoord'))
+    return footprints
+
+
+def _intersects(footprint, limit):
+    '''Check whether a granule footprint (west, east, south, north)
+    intersects a domain limit [[lon0, lon1], [lat0, lat1]]. Footprints with
+    west > east cross the dateline.
+    '''
+    west, east, south, north = footprint
+    (lon0, lon1), (lat0, lat1) = limit
+    if north < lat0 or south > lat1: return False
+    if west <= east: return not (east < lon0 or west > lon1)
+    return lon1 >= west or lon0 <= east
+
+
+#===============================================================================
+# Level-2 granule filename fields
+#===============================================================================
+_GRANULE_NAME = re.compile(r'^(?P<product>[^.]+)\.A(?P<date>\d{7})\.'
+                           r'(?P<hhmm>\d{4})\.(?P<collection>\d{3})\.'
+                           r'(?P<production>\d{13})\.hdf$')
+
+_C6_AODFIELDS = ['Longitude', 'Latitude', 'Scan_Start_Time',
+                 'AOD_550_Dark_Target_Deep_Blue_Combined',
+                 'AOD_550_Dark_Target_Deep_Blue_Combined_QA_Flag']
+_C5_AODFIELDS = ['Longitude', 'Latitude', 'Scan_Start_Time',
+                 'Optical_Depth_Land_And_Ocean',
+                 'Deep_Blue_Aerosol_Optical_Depth_550_Land',
+                 'Quality_Assurance_Land']
+
+
+def _parse_granule_name(filename):
+    '''Split a Level-2 granule filename, eg
+    MYD04_L2.A2016162.1045.006.2016165154520.hdf, into a dictionary of
+    'product', 'date' (yyyyjjj), 'hhmm', 'collection' and 'production'
+    (yyyyjjjHHMMSS) strings. Returns None for other filenames.'''
+    match = _GRANULE_NAME.match(os.path.basename(filename))
+    return match.groupdict() if match else None
+
+
+def latest_versions(files):
+    '''Keep only the newest production version of each granule. Files are
+    grouped by (product, date, HHMM, collection) from their names; other
+    filenames are kept as they are.
+
+    Args:
+     * files (list) granule filenames
+
+    Returns:
+     * (latest, superseded) lists of filenames, latest in input order
+    '''
+    newest = {}
+    for f in files:
+        name = _parse_granule_name(f)
+        if name is None: continue
+        key = (name['product'], name['date'], name['hhmm'],
+               name['collection'])
+        if key not in newest or name['production'] > newest[key][0]:
+            newest[key] = (name['production'], f)
+    keep = set(f for _, f in newest.values())
+    latest, superseded = [], []
+    for f in files:
+        if _parse_granule_name(f) is None or f in keep:
+            latest.append(f)
+        else:
+            superseded.append(f)
+    return latest, superseded
+
+
+#===============================================================================
+# SQLite inventory of local Level-2 granules
+#===============================================================================
+class GranuleIndex(object):
+    '''Inventory of local Level-2 granules kept in a SQLite file. Each
+    granule row holds its filename fields, the lon/lat bounds and
+    Scan_Start_Time range of its valid AOD samples and the number of valid
+    samples, so granules covering a region and time can be selected without
+    opening files. update() only reads new or modified files (by size and
+    mtime).
+
+    Args:
+     * dbfile (str) SQLite database filename (created if missing)
+
+    Example:
+    ::
+        with GranuleIndex('/data/modis/granules.sqlite') as idx:
+            idx.update('/data/modis/MYD04_L2/2016')
+            files = idx.select(product='MYD04_L2', start='2016162',
+                               end='2016163', limit=[[-30, 40], [30, 70]])
+    '''
+
+    _columns = ('path', 'product', 'date', 'hhmm', 'collection',
+                'production', 'size', 'mtime', 'west', 'east', 'south',
+                'north', 'time_min', 'time_max', 'nvalid')
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.db = sqlite3.connect(dbfile)
+        self.db.text_factory = str
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS granules ('
+            'path TEXT PRIMARY KEY, product TEXT, date TEXT, hhmm TEXT, '
+            'collection TEXT, production TEXT, size INTEGER, mtime REAL, '
+            'west REAL, east REAL, south REAL, north REAL, '
+            'time_min REAL, time_max REAL, nvalid INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS granules_when ON '
+                        'granules (product, date, hhmm)')
+        self.db.commit()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        self.db.close()
+
+
+    def _listfiles(self, paths):
+        '''Expand directories (recursively), glob patterns and filenames
+        into (roots, files).'''
+        if isinstance(paths, basestring): paths = [paths]
+        roots, files = [], []
+        for p in paths:
+            if os.path.isdir(p):
+                roots.append(os.path.join(os.path.abspath(p), ''))
+                for d, _, names in os.walk(p):
+                    files.extend(os.path.join(d, n) for n in names
+                                 if n.endswith('.hdf'))
+            else:
+                files.extend(glob.glob(p))
+        return roots, [os.path.abspath(f) for f in files]
+
+
+    def update(self, paths, aodfields=None, verbose=False):
+        '''Add new or modified granules under paths to the index and drop
+        entries for files removed from the scanned directories.
+
+        Args:
+         * paths (str or list) directories, glob patterns or filenames
+
+        Kwargs:
+         * aodfields (list) SDS names as in Level2Files (def: collection 5
+           or 6 defaults)
+         * verbose (bool) print each granule read
+
+        Returns:
+         * (updated, removed) number of rows
+        '''
+        roots, files = self._listfiles(paths)
+        known = dict((r[0], (r[1], r[2])) for r in self.db.execute(
+            'SELECT path, size, mtime FROM granules'))
+        updated = 0
+        for f in sorted(files):
+            name = _parse_granule_name(f)
+            if name is None: continue
+            st = os.stat(f)
+            if known.get(f) == (st.st_size, st.st_mtime): continue
+
+            collection = 5 if name['collection'] in ('005', '051') else 6
+            fields = aodfields or (_C5_AODFIELDS if collection == 5 else
+                                   _C6_AODFIELDS)
+            if verbose: print 'Indexing', os.path.basename(f)
+            try:
+                stime, lon, lat, _, _ = _read_granule(f, collection, fields)
+            except IOError as e:
+                print e
+                continue
+
+            bounds = [None] * 6
+            if lon.size > 0:
+                west, east = float(lon.min()), float(lon.max())
+                if east - west > 180 and (lon > 0).any() and (lon < 0).any():
+                    # swath crossing the dateline: west > east
+                    west = float(lon[lon > 0].min())
+                    east = float(lon[lon < 0].max())
+                bounds = [west, east, float(lat.min()), float(lat.max()),
+                          float(stime.min()), float(stime.max())]
+
+            row = [f, name['product'], name['date'], name['hhmm'],
+                   name['collection'], name['production'], st.st_size,
+                   st.st_mtime] + bounds + [int(lon.size)]
+            self.db.execute('INSERT OR REPLACE INTO granules VALUES (%s)' %
+                            ','.join('?' * len(row)), row)
+            updated += 1
+            if updated % 100 == 0: self.db.commit()
+
+        # Forget files that have gone from the scanned directories
+        present = set(files)
+        gone = [p for p in known for r in roots
+                if p.startswith(r) and p not in present]
+        self.db.executemany('DELETE FROM granules WHERE path = ?',
+                            [(p,) for p in set(gone)])
+        self.db.commit()
+        return updated, len(set(gone))
+
+
+    def select(self, product=None, collection=None, start=None, end=None,
+               valid_time=None, limit=None, min_valid=1, directory=None,
+               rows=False):
+        '''Select granules from the index.
+
+        Kwargs:
+         * product (str) product code, eg MYD04_L2
+         * collection (int or str) MODIS collection, eg 6 or '006'
+         * start, end (datetime or str) inclusive granule time range;
+           strings in yyyyjjj or yyyyjjjHHMM form
+         * valid_time ([str, str]) HHMM range within each day
+         * limit (list) [[lon0, lon1], [lat0, lat1]] domain the valid
+           samples must intersect
+         * min_valid (int) minimum number of valid samples (def: 1)
+         * directory (str) only granules below this directory
+         * rows (bool) return dictionaries of all columns instead of paths
+
+        Returns:
+         * list of granule filenames (or rows) in time order
+        '''
+        def when(t, default):
+            if t is None: return None
+            if isinstance(t, dt): return t.strftime('%Y%j%H%M')
+            return (str(t) + default)[:11]
+
+        query, args = [], []
+        if product:
+            query.append('product = ?'); args.append(product)
+        if collection:
+            query.append('collection = ?'); args.append('%03d' % int(collection))
+        if start is not None:
+            query.append('date || hhmm >= ?'); args.append(when(start, '0000'))
+        if end is not None:
+            query.append('date || hhmm <= ?'); args.append(when(end, '2400'))
+        if valid_time:
+            query.append('hhmm BETWEEN ? AND ?'); args.extend(valid_time)
+        if min_valid:
+            query.append('nvalid >= ?'); args.append(min_valid)
+        if limit is not None:
+            query.append('north >= ? AND south <= ?'); args.extend(limit[1])
+        if directory:
+            directory = os.path.join(os.path.abspath(directory), '')
+            query.append('substr(path, 1, ?) = ?')
+            args.extend([len(directory), directory])
+
+        sql = 'SELECT %s FROM granules' % ', '.join(self._columns)
+        if query: sql += ' WHERE ' + ' AND '.join(query)
+        sql += ' ORDER BY date, hhmm, path'
+        found = [dict(zip(self._columns, r))
+                 for r in self.db.execute(sql, args)]
+        if limit is not None:
+            found = [r for r in found if _intersects(
+                (r['west'], r['east'], r['south'], r['north']), limit)]
+        return found if rows else [r['path'] for r in found]
+
+
 class Level2Files:
     '''MODIS aerosol Level-2 hdf read/write/plot module.
 
@@ -49,6 +732,12 @@ class Level2Files:
      * password (str) password for NRT data access
      * local (str) Local path to store level2 files. Only updated via the
        download() method.
+     * cachedir (str) Directory for per-granule extracted arrays reused by
+       consolidateDailyAod() (def: None ie no cache)
+     * cachesize (real) Maximum cache size in bytes (def: 2e9)
+     * superseded (str) What to do with older production versions of a
+       granule found next to a reprocessed one: 'ignore' (def), 'delete'
+       from disk, or 'keep' reading all versions
     '''
 
     def __init__(self, collection=6, nrt=False, **kw):
@@ -58,6 +747,9 @@ class Level2Files:
         self.daytitle = None
         self.daybase = None
         self.imagefile = None
+        self.new_files = []
+        self.timing = {}
+        self.sessions = FTPPool()
         self.collection = collection
         self.status = [0, 0]  # download status, consolidate status
         self.nrt = nrt
@@ -65,14 +757,14 @@ class Level2Files:
         self.product = kw.get('product', 'MYD04_L2')
         self.username = kw.get('username', None)
         self.password = kw.get('password', None)
+        self.cachedir = kw.get('cachedir', None)
+        self.cachesize = kw.get('cachesize', 2e9)
+        self.superseded = kw.get('superseded', 'ignore')
         self.c6nrt = r'nrt3.modaps.eosdis.nasa.gov/allData/6'
         self.c6sci = r'ladsftp.nascom.nasa.gov/allData/6'
         self.c5nrt = r'nrt2.modaps.eosdis.nasa.gov/allData/1'
         self.c5sci = r'ladsftp.nascom.nasa.gov/allData/51'
-        self.aodfields = kw.get('aodfields',
-                                ['Longitude', 'Latitude', 'Scan_Start_Time',
-                                 'AOD_550_Dark_Target_Deep_Blue_Combined',
-                                 'AOD_550_Dark_Target_Deep_Blue_Combined_QA_Flag'])
+        self.aodfields = kw.get('aodfields', list(_C6_AODFIELDS))
 
 
     def __enter__(self):
@@ -102,13 +794,17 @@ class Level2Files:
 #===============================================================================
     def et2dt(self, elapsed_seconds):
         '''Returns date and time from MODIS Scan start time which is measured
-        in seconds since 1993-1-1 00:00:00.0 0.
+        in TAI seconds since 1993-1-1 00:00:00.0 0, corrected for leap
+        seconds (see utils.tai93_to_datetime64).
 
         Args:
-         * elapsed_seconds (real) Elapsed seconds since 1993-1-1
+         * elapsed_seconds (real or array) Elapsed seconds since 1993-1-1
+
+        Returns:
+         * datetime object, or a numpy.datetime64 array for array input
         '''
-        base_time = dt(1993, 1, 1, 0, 0, 0)
-        return base_time + td(seconds=elapsed_seconds)
+        times = tai93_to_datetime64(elapsed_seconds)
+        return times if np.ndim(times) > 0 else times.astype(dt)
 
 
 #===============================================================================
@@ -180,13 +876,39 @@ class Level2Files:
 #===============================================================================
 # Download Level-2 filed from NASA server
 #===============================================================================
-    def download(self, source=None, destination=None, skip_download=False):
+    def download(self, source=None, destination=None, skip_download=False,
+                 workers=1, host_limit=None, manifest_ttl=0,
+                 valid_time=['0000', '2400'], limit=None, footprints=None,
+                 callback=None):
         '''Download MODIS Level 2 files.
 
         Kwargs:
          * source (str, optional) Full FTP source for MODIS level-2 data to
            override default settings
          * destination (str, optional) Full local path to save the level2 files
+         * workers (int) Number of granules to fetch concurrently (def: 1)
+         * host_limit (int) Maximum concurrent connections per remote host
+         * manifest_ttl (real) Seconds for which a cached remote listing is
+           reused without contacting the server (def: 0 ie always list).
+           Selected granules on disk that were not reported by a previous
+           poll are stored in self.new_files
+         * valid_time ([str, str]) Only fetch granules with HHMM in this
+           range, as in consolidateDailyAod()
+         * limit ([[lon0, lon1], [lat0, lat1]]) Only fetch granules whose
+           footprint intersects this domain; requires footprints
+         * footprints (str) geoMeta filename or url giving granule bounding
+           coordinates for the day (see _read_geometa)
+         * callback (callable) Called with the local filename of each
+           selected granule as soon as it is on disk (already present or
+           just transferred)
+
+        Example (local stand-in serving a directory of dummy granules,
+        eg "cd /tmp/srv; python -m SimpleHTTPServer 8765" or
+        "python -m pyftpdlib -p 2121 -d /tmp/srv"):
+        ::
+            l2 = Level2Files(date='20160610')
+            l2.download(source='http://localhost:8765/MYD04_L2/2016/162',
+                        destination='/tmp/l2', workers=4, host_limit=2)
         '''
 
         url = self.getUrl() if source is None else source
@@ -214,38 +936,61 @@ class Level2Files:
                 sys.exit(1)
 
         # Begin download l2 files
-        cnt = 0
         try:
             # print "URL>>>" + url
-            r = urlopen(Request(url))
-            regex = r'(' + self.product + '.+?.hdf)'
-            # Read l2 filenames from manifest file
-            for line in r.readlines():
-                if '.hdf' in line:
-                    # filter file with matching regex pattern
-                    matches = re.findall(regex, line)
-                    if (len(matches) > 0):
-                        remote = url + '/' + matches[-1]
-                        local = self.local + '/' + matches[-1]
-                        # Download new files
-                        if not os.path.exists(local):
-                            cnt += 1
-                            #print ' Downloading ' + matches[-1]
-                            print matches[-1]
-                            with closing(urlopen(remote)) as r:
-                                with open(local, 'wb') as f:
-                                    copyfileobj(r, f)
-
-            if (cnt > 0):
+            bounds = {}
+            if limit is not None and footprints is not None:
+                bounds = _read_geometa(footprints)
+
+            listing = self.cachedListing(url, ttl=manifest_ttl)
+            if self.superseded != 'keep':
+                # Only fetch the newest production version of each granule
+                latest = set(latest_versions([n for n, _ in listing])[0])
+                listing = [(n, s) for n, s in listing if n in latest]
+
+            jobs, selected = [], []
+            for name, size in listing:
+                # Skip listed names not in A<yyyyjjj>.<HHMM> granule form
+                granule = _parse_granule_name(name)
+                if granule is None: continue
+                hhmm = int(granule['hhmm'])
+                if hhmm < int(valid_time[0]) or hhmm > int(valid_time[1]):
+                    continue
+                key = 'A' + granule['date'] + '.' + granule['hhmm']
+                if key in bounds and not _intersects(bounds[key], limit):
+                    continue
+
+                selected.append(name)
+                local = self.local + '/' + name
+                # Download new files and re-fetch truncated ones
+                if not os.path.exists(local) or \
+                   (size is not None and os.path.getsize(local) != size):
+                    jobs.append((url + '/' + name, local))
+                elif callback is not None:
+                    callback(local)
+
+            if len(jobs) > 0:
+                _done, failed = self.fetchFiles(jobs, workers=workers,
+                                                host_limit=host_limit,
+                                                callback=callback)
+                self.commitListing(selected,
+                                   [remote for remote, _ in failed])
+                if len(failed) > 0:
+                    raise URLError('{} of {} transfers failed'.format(
+                        len(failed), len(jobs)))
                 print dt.utcnow().strftime('%T') + ' Download complete.\n'
             else:
+                self.commitListing(selected)
                 print 'All remote files already in: ' + self.local
 
         except KeyboardInterrupt:
             print 'Interrupted'
             sys.exit(0)
-        except URLError, e:
-            print ' ** URLError=' + str(e.reason)
+        except (URLError,) + ftplib.all_errors, e:
+            # ftp listings and transfers go through ftplib (see FTPPool), so
+            # socket errors and 4xx/5xx replies fail the download as URLError
+            print ' ** {0}={1}'.format(type(e).__name__,
+                                       getattr(e, 'reason', e))
             print ' Hint: switching remote server might help'
             if not os.listdir(self.local):
                 # remove local directory if empty
@@ -254,22 +999,295 @@ class Level2Files:
             return(self.status[0])
 
 
+#===============================================================================
+# Read Level-2 filenames from remote manifest
+#===============================================================================
+    def listRemote(self, url):
+        '''Return Level-2 filenames in a remote directory listing.
+
+        Args:
+         * url (str) Remote directory url (ftp/http/file); ftp listings use
+           a session from self.sessions
+
+        Returns:
+         * list of (filename, size) tuples for hdf files matching
+           self.product; size (bytes) is None unless the listing is in FTP
+           "ls -l" form
+        '''
+        names = []
+        regex = r'(' + self.product + '.+?.hdf)'
+        if urlparse(url).scheme == 'ftp':
+            # List over a pooled session rather than a new login
+            path = unquote(urlparse(url).path)
+
+            def listing(ftp):
+                lines = []
+                ftp.retrlines('LIST ' + path, lines.append)
+                return lines
+            lines = self.sessions.run(url, listing)
+        else:
+            with closing(urlopen(Request(url))) as r:
+                lines = r.readlines()
+
+        # Read l2 filenames from manifest file
+        for line in lines:
+            if '.hdf' in line:
+                # filter file with matching regex pattern
+                matches = re.findall(regex, line)
+                if (len(matches) > 0):
+                    fields = line.split()
+                    size = int(fields[4]) if len(fields) > 8 and \
+                        fields[4].isdigit() else None
+                    names.append((matches[-1], size))
+        return names
+
 
 #===============================================================================
-# Concatenate level-2 swath files into single vector array
+# Remote listing through a local manifest cache
 #===============================================================================
-    def consolidateDailyAod(self, filepath=None, valid_time=['0000', '2400'],
-                            skip_download=False):
-        '''Concatenate AOD data from available 5 minute swath files in to
-        single array.
+    def cachedListing(self, url, ttl=0):
+        '''Return the remote Level-2 listing using a manifest cache stored in
+        the local day directory.
+
+        Args:
+         * url (str) Remote directory url
 
         Kwargs:
-         * filepath (str) Location of Level-2 5minute swath files (hdf)
+         * ttl (real) Seconds for which the cached listing is reused without
+           contacting the server (def: 0 ie always list)
+
+        Returns:
+         * list of (filename, size) tuples, see listRemote()
+
+        The manifest is not updated here; call commitListing() with the
+        selected granules once they have been transferred.
+        '''
+        manifest = os.path.join(self.local, '.manifest.json')
+        key = re.sub(r'//[^/@]*@', '//', url)  # drop credentials
+        cache = None
+        if os.path.exists(manifest):
+            try:
+                with open(manifest) as f:
+                    cache = json.load(f)
+            except ValueError:
+                cache = None
+        if cache is not None and cache.get('url') != key:
+            cache = None
+
+        self._listing = None
+        self.new_files = []
+        if cache is not None and time.time() - cache['time'] < ttl:
+            return [(str(k), v) for k, v in sorted(cache['files'].items())]
+
+        listing = self.listRemote(url)
+        # granules already reported (older manifests only hold the listing)
+        known = {} if cache is None else cache.get('known', cache['files'])
+        self._listing = (manifest, key, time.time(), dict(listing), known)
+        return listing
+
+
+    def commitListing(self, selected=[], failed=[]):
+        '''Store the listing read by the last cachedListing() call in the
+        manifest, and record selected granules that are on disk and were
+        not reported by a previous poll in self.new_files (local
+        filenames). Granules that were skipped or failed to transfer are
+        not marked as known, so they are reported once they are fetched.
+
+        Kwargs:
+         * selected (list) filenames chosen for download from the listing
+         * failed (list) filenames that could not be transferred
+        '''
+        if getattr(self, '_listing', None) is None: return
+        manifest, key, listed, files, known = self._listing
+        failed = set(os.path.basename(name) for name in failed)
+        known = dict(known)
+        for name in selected:
+            local = os.path.join(self.local, name)
+            if name in failed or not os.path.exists(local): continue
+            if name not in known: self.new_files.append(local)
+            known[name] = files.get(name)
+        tmp = manifest + '.part'
+        with open(tmp, 'w') as f:
+            # with failures, expire the cached listing to retry next poll
+            json.dump({'url': key, 'time': 0 if failed else listed,
+                       'files': files, 'known': known}, f)
+        os.rename(tmp, manifest)
+        self._listing = None
+
+
+#===============================================================================
+# Transfer a list of remote files using a bounded pool of worker threads
+#===============================================================================
+    def fetchFiles(self, jobs, workers=1, host_limit=None, callback=None):
+        '''Download (remote, local) url pairs with a bounded worker pool and
+        report per-file and aggregate throughput.
+
+        Args:
+         * jobs (list) List of (remote url, local filename) tuples
+
+        Kwargs:
+         * workers (int) Number of concurrent transfers (def: 1 ie serial)
+         * host_limit (int) Maximum concurrent transfers per remote host
+           (def: None ie same as workers)
+         * callback (callable) Called from the worker thread with the local
+           filename of each completed transfer
+
+        Returns:
+         * done (list) (local filename, bytes, seconds) of completed transfers
+         * failed (list) (remote url, error) of failed transfers
+        '''
+        pending = Queue()
+        slots = {}
+        for remote, local in jobs:
+            pending.put((remote, local))
+            host = urlparse(remote).hostname
+            if host_limit and host not in slots:
+                slots[host] = threading.BoundedSemaphore(host_limit)
+
+        done, failed = [], []
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    remote, local = pending.get_nowait()
+                except Empty:
+                    return
+                slot = slots.get(urlparse(remote).hostname)
+                if slot: slot.acquire()
+                try:
+                    t0 = time.time()
+                    nbytes = _fetch(remote, local, pool=self.sessions)
+                    secs = max(time.time() - t0, 1e-6)
+                    with lock:
+                        done.append((local, nbytes, secs))
+                        print '{0} {1:.2f}MB {2:.2f}MB/s'.format(
+                            os.path.basename(local), nbytes / 1e6,
+                            nbytes / 1e6 / secs)
+                    if callback is not None: callback(local)
+                except Exception as e:
+                    # Any error (eg httplib.BadStatusLine, which is not an
+                    # IOError) fails this job only; partial granule is kept
+                    # as .part for the next resume
+                    with lock:
+                        failed.append((remote, e))
+                        print ' ** Failed ' + os.path.basename(local) + \
+                              ': ' + str(e)
+                finally:
+                    if slot: slot.release()
+
+        t0 = time.time()
+        nthreads = max(1, min(int(workers), len(jobs)))
+        threads = [threading.Thread(target=worker) for _ in range(nthreads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        # join with timeout so that KeyboardInterrupt reaches the main thread
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+
+        secs = max(time.time() - t0, 1e-6)
+        nbytes = sum(d[1] for d in done)
+        print '{0} files {1:.2f}MB in {2:.1f}s [{3:.2f}MB/s, {4} workers]'.format(
+            len(done), nbytes / 1e6, secs, nbytes / 1e6 / secs, nthreads)
+        return done, failed
+
+
+
+#===============================================================================
+# Compare pooled and one-off FTP sessions for granule transfers
+#===============================================================================
+    def benchmarkDownload(self, source, nfiles=None, outdir=None):
+        '''Time serial transfers of the granules listed at source with a
+        new FTP login per file and with pooled sessions (FTPPool), to show
+        the per-file connection overhead. Source can be a local stand-in,
+        eg a pyftpdlib server (python -m pyftpdlib -p 2121 -d <granules>).
+
+        Args:
+         * source (str) Remote (ftp) directory url
+
+        Kwargs:
+         * nfiles (int) Number of granules to transfer (def: all listed)
+         * outdir (str) directory for the test downloads (def: temporary
+           directory, removed afterwards)
 
         Returns:
-         * consolidated arrays (1D) of: scan_time, longitude, latitude, aod550,
-           quality_indicator
+         * list of (mode, seconds per file, logins) tuples
         '''
+        import shutil
+        import tempfile
+        names = [n for n, _ in self.listRemote(source)][:nfiles]
+        if len(names) == 0:
+            print 'No ' + self.product + ' files in ' + source
+            return []
+
+        workdir = outdir or tempfile.mkdtemp()
+        results = []
+        try:
+            for mode in ('one-off', 'pooled'):
+                pool = FTPPool() if mode == 'pooled' else None
+                t0 = time.time()
+                for name in names:
+                    local = os.path.join(workdir, mode + '.' + name)
+                    _fetch(source.rstrip('/') + '/' + name, local, pool=pool)
+                secs = (time.time() - t0) / len(names)
+                logins = pool.logins if pool is not None else len(names)
+                if pool is not None: pool.close()
+                results.append((mode, secs, logins))
+        finally:
+            if outdir is None: shutil.rmtree(workdir)
+
+        print '{0:>8s} {1:>10s} {2:>7s}'.format('mode', 'ms/file', 'logins')
+        for mode, secs, logins in results:
+            print '{0:>8s} {1:10.1f} {2:7d}'.format(mode, secs * 1e3, logins)
+        return results
+
+
+#===============================================================================
+# Iterate over level-2 swath files one granule at a time
+#===============================================================================
+    def iterGranules(self, filepath=None, valid_time=['0000', '2400'],
+                     fields=None, skip_download=False, pipeline=False,
+                     processes=1, index=None, **kw):
+        '''Generator of valid AOD samples from available 5 minute swath
+        files, one granule at a time, so that a day (or many days) can be
+        processed with memory bounded by a single swath.
+
+        Kwargs:
+         * filepath (str) Location of Level-2 5minute swath files (hdf)
+         * valid_time ([str, str]) HHMM range of granules to read
+         * fields (list) Subset of 'scan_time', 'lon', 'lat', 'aod550',
+           'quality_flag' to return (def: all)
+         * skip_download (bool) Only read granules already on disk
+         * pipeline (bool) Read each granule as soon as its transfer completes
+           so that hdf decoding overlaps the download (def: False)
+         * processes (int) Number of worker processes decoding granules in
+           parallel (def: 1 ie decode in this process)
+         * index (GranuleIndex or str) Select granules through a granule
+           index (or SQLite filename) updated for the local directory,
+           instead of globbing; also applies limit to the valid samples.
+           Not supported with pipeline downloads (ValueError)
+         * workers, host_limit, manifest_ttl, limit, footprints: passed to
+           download()
+
+        Yields:
+         * (meta, data) tuples; meta is a dictionary with granule 'filename',
+           'product', 'date' (Ayyyyjjj), 'hhmm', 'collection' and 'nsamples',
+           data a dictionary of 1D arrays keyed by field name. Granules come
+           in filename order, or in arrival order in pipeline mode. Stage
+           times are left in self.timing.
+        '''
+        if self.collection == 5:
+            if len(self.aodfields) < 6 :
+                self.aodfields[3:5] = ['Optical_Depth_Land_And_Ocean',
+                               'Deep_Blue_Aerosol_Optical_Depth_550_Land',
+                               'Quality_Assurance_Land']
+        elif self.collection != 6:
+            raise ValueError('Invalid Collection ' + str(self.collection))
+        if index is not None and pipeline is True and skip_download is False:
+            raise ValueError('index cannot select granules as they are '
+                             'downloaded; use pipeline=False')
 
         # Download files
         if skip_download is False:
@@ -277,144 +1295,324 @@ class Level2Files:
                   ((self.nrt is True) and 'NRT' or 'SCIENCE') + \
                   ' product: ' + self.product
 
-        # assign destination if given
-        self.download(destination=filepath, skip_download=skip_download)
+        if self.cachedir is not None and not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+
+        fields = _GRANULE_FIELDS if fields is None else fields
+        self.timing = {'download': 0., 'decode': 0., 'granules': 0}
+        t0 = time.time()
+
+        def item(hdfi, arrays):
+            z = os.path.basename(hdfi).split('.')
+            meta = {'filename': hdfi, 'product': z[0], 'date': z[1],
+                    'hhmm': z[2], 'collection': z[3],
+                    'nsamples': arrays[0].size}
+            data = dict((k, v) for k, v in zip(_GRANULE_FIELDS, arrays)
+                        if k in fields)
+            self.timing['granules'] += 1
+            return meta, data
+
+        # Decode in worker processes if asked, otherwise in this process
+        pool = Pool(processes) if processes > 1 else None
+        inflight = deque()
+        thread = None
+        try:
+            if pipeline is True and skip_download is False:
+                # Producer thread downloads, this thread decodes granules as
+                # they land
+                arrived = Queue()
+
+                def producer():
+                    try:
+                        self.download(destination=filepath,
+                                      valid_time=valid_time,
+                                      callback=arrived.put, **kw)
+                    except Exception as e:
+                        # Errors download() lets through would otherwise
+                        # end the thread and leave status[0] at 0
+                        print ' ** Download failed: {0}={1}'.format(
+                            type(e).__name__, e)
+                        self.status[0] = -1
+                    finally:
+                        arrived.put(None)
+
+                def arrivals():
+                    # Skip granules already read in the same or a newer
+                    # production version, unless superseded ones are kept
+                    seen = {}
+                    while True:
+                        try:
+                            hdfi = arrived.get(timeout=0.5)
+                        except Empty:
+                            continue
+                        if hdfi is None: return
+                        name = _parse_granule_name(hdfi)
+                        if name is not None and self.superseded != 'keep':
+                            key = (name['product'], name['date'],
+                                   name['hhmm'], name['collection'])
+                            if key in seen and \
+                               seen[key] >= name['production']:
+                                continue
+                            seen[key] = name['production']
+                        yield hdfi
+
+                thread = threading.Thread(target=producer)
+                thread.daemon = True
+                thread.start()
+                source = arrivals()
+            else:
+                # assign destination if given
+                self.download(destination=filepath,
+                              skip_download=skip_download,
+                              valid_time=valid_time, **kw)
+                self.timing['download'] = time.time() - t0
+                if self.status[0] != 0:
+                    self.status[1] = -1
+                    return
+
+                if index is not None:
+                    # Query the granule inventory
+                    idx = GranuleIndex(index) \
+                        if isinstance(index, basestring) else index
+                    try:
+                        idx.update(self.local, aodfields=self.aodfields)
+                        hdfiles = idx.select(product=self.product,
+                                             directory=self.local,
+                                             valid_time=valid_time,
+                                             limit=kw.get('limit'))
+                    finally:
+                        if idx is not index: idx.close()
+                else:
+                    # Search all hdf files
+                    allfiles = glob.glob('/'.join([self.local, '*.hdf']))
+                    hdfiles = []
+                    for k in allfiles:
+                        hhmm = int(os.path.basename(k).split('.')[2])
+                        if (hhmm >= int(valid_time[0]) and
+                            hhmm <= int(valid_time[1])):
+                            hdfiles.append(k)
+
+                hdfiles = self.latestGranules(hdfiles)
+
+                if (len(hdfiles) > 0):
+                    print dt.utcnow().strftime('%T') + \
+                          ' Consolidating swath files...',
+                source = iter(sorted(hdfiles))
+
+            for hdfi in source:
+                if pool is None:
+                    t1 = time.time()
+                    arrays = self.readGranule(hdfi)
+                    self.timing['decode'] += time.time() - t1
+                    yield item(hdfi, arrays)
+                    continue
+
+                # Keep a few granules in flight per worker
+                inflight.append((hdfi, pool.apply_async(
+                    _cached_read_granule, (hdfi, self.collection,
+                                           self.aodfields, self.cachedir))))
+                while len(inflight) >= 2 * processes:
+                    hdfi, result = inflight.popleft()
+                    t1 = time.time()
+                    arrays = result.get()
+                    self.timing['decode'] += time.time() - t1
+                    yield item(hdfi, arrays)
+
+            while len(inflight) > 0:
+                hdfi, result = inflight.popleft()
+                t1 = time.time()
+                arrays = result.get()
+                self.timing['decode'] += time.time() - t1
+                yield item(hdfi, arrays)
+
+            if thread is not None:
+                thread.join()
+                self.timing['download'] = time.time() - t0
+                if self.status[0] != 0:
+                    self.status[1] = -1
+                    return
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if self.cachedir is not None:
+            _evict_cache(self.cachedir, self.cachesize)
+
+
+#===============================================================================
+# Concatenate level-2 swath files into single vector array
+#===============================================================================
+    def consolidateDailyAod(self, filepath=None, valid_time=['0000', '2400'],
+                            skip_download=False, pipeline=False, processes=1,
+                            **kw):
+        '''Concatenate AOD data from available 5 minute swath files in to
+        single array. See iterGranules() for reading granule by granule.
+
+        Kwargs:
+         * filepath (str) Location of Level-2 5minute swath files (hdf)
+         * pipeline (bool) Read each granule as soon as its transfer completes
+           so that hdf decoding overlaps the download (def: False)
+         * processes (int) Number of worker processes decoding granules in
+           parallel (def: 1 ie decode in this process)
+         * workers, host_limit, manifest_ttl, limit, footprints: passed to
+           download()
+
+        Returns:
+         * consolidated contiguous arrays (1D) of: scan_time (float64),
+           longitude, latitude, aod550 (float32), quality_indicator (int16)
+        '''
+        t0 = time.time()
+        granules = []
+        for meta, data in self.iterGranules(filepath=filepath,
+                                            valid_time=valid_time,
+                                            skip_download=skip_download,
+                                            pipeline=pipeline,
+                                            processes=processes, **kw):
+            granules.append((meta['filename'], data))
         if self.status[0] != 0:
+            return None, None, None, None, None
+
+        if len(granules) == 0:
+            print 'No Level-2 files in ' + str(self.local)
             self.status[1] = -1
             return None, None, None, None, None
 
-        # Search all hdf files
-        allfiles = glob.glob('/'.join([self.local, '*.hdf']))
-        hdfiles = []
-        for k in allfiles:
-            if (int(k.split('.')[2]) >= int(valid_time[0]) and
-                int(k.split('.')[2]) <= int(valid_time[1])):
-                hdfiles.append(k)
-
-        # hdfiles = glob.glob('/'.join([self.local, '*.hdf']))
-
-        # Initialise consolidated arrays:
-        caod, clon, clat, ctime, cqf = [], [], [], [], []
-
-        if (len(hdfiles) > 0):
-            print dt.utcnow().strftime('%T') + \
-                  ' Consolidating swath files...',
-
-            if self.collection == 6:
-                for hdfi in hdfiles:
-                    lon, lat, time, aodc, qf = get_sd(FILENAME=hdfi,
-                                                      SDSNAME=self.aodfields,
-                                                      QUIET=True)
-                    aod = aodc.get()
-                    fill = aodc.getfillvalue()
-                    scale = aodc.scale_factor
-                    offset = aodc.add_offset
-                    w = np.where(aod > fill)
-                    clon.append(lon.get()[w])
-                    clat.append(lat.get()[w])
-                    ctime.append(time.get()[w])
-                    cqf.append(qf.get()[w])
-                    caod.append(scale * aod[w] + offset)
-            elif self.collection == 5:
-                if len(self.aodfields) < 6 :
-                    self.aodfields[3:5] = ['Optical_Depth_Land_And_Ocean',
-                                   'Deep_Blue_Aerosol_Optical_Depth_550_Land',
-                                   'Quality_Assurance_Land']
-
-                for hdfi in hdfiles:
-                    lon, lat, time, aodc, aodd, qfl = \
-                    get_sd(FILENAME=hdfi, SDSNAME=self.aodfields, QUIET=True)
-
-                    qfl5 = qfl.get()[:, :, 4]
-
-                    # Combine DeepBlue and LandOcean AODs
-                    aod = aodc.get()
-                    fill = aodc.getfillvalue()
-                    t = np.where(aod == fill)
-                    if len(t) > 0:
-                        aod[t] = aodd.get()[t]
-
-                    scale = aodc.scale_factor
-                    offset = aodc.add_offset
-                    w = np.where(aod > fill)
-                    clon.append(lon.get()[w])
-                    clat.append(lat.get()[w])
-                    ctime.append(time.get()[w])
-                    cqf.append(qfl5[w])
-                    caod.append(scale * aod[w] + offset)
+        # Concatenate per-granule arrays into contiguous daily arrays
+        granules.sort(key=lambda g: g[0])
+        hdfiles = [g[0] for g in granules]
+        ctime, clon, clat, caod, cqf = \
+            [np.concatenate([g[1][k] for g in granules])
+             for k in _GRANULE_FIELDS]
 
-            else:
-                raise ('Invalid Collection ' + str(self.collection))
-                sys.exit(0)
+        self.setDayNames(hdfiles[-1])
+        print ' done'
+        print ' Download {0:.1f}s, decode {1:.1f}s ({2} granules), ' \
+              'total {3:.1f}s'.format(self.timing['download'],
+                                      self.timing['decode'], len(hdfiles),
+                                      time.time() - t0)
+        return ctime, clon, clat, caod, cqf
 
-        # Flatten list elements
-        ctime = [val for sublist in ctime for val in sublist]
-        clon = [val for sublist in clon for val in sublist]
-        clat = [val for sublist in clat for val in sublist]
-        caod = [val for sublist in caod for val in sublist]
-        cqf = [val for sublist in cqf for val in sublist]
 
+#===============================================================================
+# Daily output names from a granule filename
+#===============================================================================
+    def setDayNames(self, hdfi):
+        '''Set self.daytitle and self.daybase (used to name daily output
+        files) from the last granule of the day.
+
+        Args:
+         * hdfi (str) Level 2 MODIS hdf filename
+        '''
         z = os.path.basename(hdfi).split('.')
         z[2] = 'daily'
         if self.nrt is not True: z[4] = 'SCI'
         self.daytitle = '.'.join([z[i] for i in (0, 1, 3, 4)])
         self.daybase = '.'.join([z[i] for i in (0, 1, 2, 3, 4)])
-        print ' done'
-        return ctime, clon, clat, caod, cqf
 
 
 #===============================================================================
-# Write Level-2 AOD from hdf into text CSV file (lon,lat,time,aod,quality_flag
+# Read valid AOD samples from one level-2 swath file
 #===============================================================================
-    def writecsvAod(self, hdfile, csvfile=None, deletehdf=False):
-        '''Read AOD dataset from MODIS c6 hdf and write output to a csv file.
+    def readGranule(self, hdfi):
+        '''Read valid AOD samples from a single Level-2 swath file.
 
         Args:
-         * hdfile (str) Level 2 MODIS-C6 AOD hdf filename
+         * hdfi (str) Level 2 MODIS hdf filename; arrays are reused from
+           self.cachedir when available
 
-        Kwargs:
-         * csvfile (str) Output csv filename
-         * deletehdf (bool) Remove hdf file after csv write
+        Returns:
+         * 1D arrays of: scan_time (float64), longitude, latitude,
+           aod550 (float32) and quality_indicator (int16)
         '''
+        return _cached_read_granule(hdfi, self.collection, self.aodfields,
+                                    self.cachedir)
 
-        if csvfile is None:
-                csvfile = os.path.splitext(hdfile)[0] + '.AOD550.csv'
 
-        lon, lat, time, aod, qf = get_sd(FILENAME=hdfile,
-                                         SDSNAME=self.aodfields)
+#===============================================================================
+# Drop superseded (reprocessed) granule versions
+#===============================================================================
+    def latestGranules(self, hdfiles):
+        '''Keep only the newest production version of each granule, eg
+        MYD04_L2.A2016162.1045.006.2016165154520.hdf over the same granule
+        with an older production timestamp. Older versions are ignored or
+        deleted according to self.superseded.
 
-        # Get AOD scaling parameters
-        scale = aod.scale_factor
-        offset = aod.add_offset
+        Args:
+         * hdfiles (list) Level 2 MODIS hdf filenames
 
-        # Get valid sample index
-        w = np.where(aod.get() > -9999)
+        Returns:
+         * list of filenames with superseded versions removed
+        '''
+        if self.superseded == 'keep': return hdfiles
+        latest, superseded = latest_versions(hdfiles)
+        if len(superseded) > 0:
+            print 'Skipping', len(superseded), 'superseded granule(s)' + \
+                  (self.superseded == 'delete' and ' (deleted)' or '')
+        if self.superseded == 'delete':
+            for f in superseded:
+                os.remove(f)
+        return latest
 
-        vlon = lon.get()[w]
-        vlat = lat.get()[w]
-        vtime = time.get()[w]
-        vqf = qf.get()[w]
 
-        # Apply linear scaling to AOD before writing.  "Linear scaling" is
-        # assumed here, check the original definition to see if this is
-        # still the case
-        vaod = scale * aod.get()[w] + offset
+#===============================================================================
+# Write Level-2 AOD from hdf into text CSV file (lon,lat,time,aod,quality_flag
+#===============================================================================
+    def writecsvAod(self, hdfile, csvfile=None, deletehdf=False,
+                    compress=False, workers=1):
+        '''Read AOD dataset from MODIS hdf and write output to a csv file.
+        Rows are converted and written in blocks, so a granule takes a
+        fraction of a second.
 
-        if (vaod.size > 0):
-            if (deletehdf is True): os.remove(hdfile)
+        Args:
+         * hdfile (str) Level 2 MODIS AOD hdf filename, or a directory of
+           granules to convert in batch
 
-            # Write fields to csv file
+        Kwargs:
+         * csvfile (str) Output csv filename (output directory if hdfile is
+           a directory; def: next to each hdf file)
+         * deletehdf (bool) Remove hdf file after csv write
+         * compress (bool) Write gzip compressed csv (.csv.gz)
+         * workers (int) Number of processes converting granules of a
+           directory in parallel (def: 1)
 
-            with open(csvfile, 'wb') as fi:
-                print ' Writing ' + csvfile
-                writer = csv.writer(fi)
-                writer.writerow(self.aodfields)
-                for i, _ in enumerate(vaod):
-                    writer.writerow([vlon[i], vlat[i], self.et2dt(vtime[i]),
-                                     vaod[i], vqf[i]])
+        Returns:
+         * number of rows written
+        '''
+        ext = '.AOD550.csv' + (compress and '.gz' or '')
+        aodfields = self.aodfields
+        if self.collection == 5 and len(aodfields) < 6:
+            aodfields = list(_C5_AODFIELDS)
+        if os.path.isdir(hdfile):
+            hdfiles = self.latestGranules(
+                sorted(glob.glob(os.path.join(hdfile, '*.hdf'))))
+            outdir = csvfile
+            if outdir is not None and not os.path.exists(outdir):
+                os.makedirs(outdir)
+        else:
+            hdfiles = [hdfile]
+            outdir = None
+
+        jobs = []
+        for hdfi in hdfiles:
+            out = csvfile if outdir is None and csvfile is not None else \
+                os.path.splitext(hdfi)[0] + ext
+            if outdir is not None:
+                out = os.path.join(outdir, os.path.basename(out))
+            jobs.append(((hdfi, out, self.collection, aodfields),
+                         {'cachedir': self.cachedir, 'deletehdf': deletehdf,
+                          'compress': compress}))
+
+        if workers > 1 and len(jobs) > 1:
+            pool = Pool(workers)
+            try:
+                counts = pool.map(_write_csv_job, jobs)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            print ' ** Not enough valid AOD retrievals **'
-            if (deletehdf is True): os.remove(hdfile)
+            counts = map(_write_csv_job, jobs)
+        return sum(counts)
 
 
 #===============================================================================
@@ -422,27 +1620,103 @@ class Level2Files:
 #===============================================================================
     def writencDailyAod(self, ncfile=None, filepath=None,
                         download=True, **kw):
-        '''Write daily consolidated MODIS AOD data to netCDF file.
+        '''Write daily consolidated MODIS AOD data to netCDF file. The file
+        is written under a temporary name and renamed when complete.
 
         Kwargs:
          * ncfile (str) output netcdf filename
          * filepath (str) override default level 2 file path
          * format (str) netcdf format, default: NETCDF4
+         * stream (bool) append granule by granule along an unlimited sample
+           dimension, so that only one granule is held in memory
+           (def: False ie consolidate the day first)
+         * chunksize (int) samples per chunk, independent of the (possibly
+           unlimited) dimension length (def: 65536)
+         * complevel (int) deflate level 1-9, 0 for no compression (def: 4)
+         * shuffle (bool) apply HDF5 shuffle filter (def: True)
+         * valid_time, pipeline, processes, ...: passed to
+           consolidateDailyAod() / iterGranules()
         '''
         from netCDF4 import Dataset
-        ncformat = kw.get('format', 'NETCDF4')
+        ncformat = kw.pop('format', 'NETCDF4')
+        stream = kw.pop('stream', False)
+        opts = {'chunksize': kw.pop('chunksize', 65536),
+                'complevel': kw.pop('complevel', 4),
+                'shuffle': kw.pop('shuffle', True)}
         skip = not download
 
-        time, lon, lat, aod, qf = self.consolidateDailyAod(filepath=filepath,
-                                                           skip_download=skip)
-
-        if self.status[1] != 0: return -1
+        if stream is False:
+            time, lon, lat, aod, qf = self.consolidateDailyAod(
+                filepath=filepath, skip_download=skip, **kw)
+            if self.status[1] != 0: return -1
+            if ncfile is None:
+                ncfile = os.path.join(self.local, self.daybase + '.nc')
+
+            print dt.utcnow().strftime('%T') + ' Writing ' + ncfile
+            tmp = '%s.%d.tmp' % (ncfile, os.getpid())
+            nc = Dataset(tmp, 'w', clobber=True, format=ncformat)
+            complete = False
+            try:
+                self._defineNcAod(nc, np.size(time), **opts)
+                # Fill variables
+                nc.variables['scan_time'][:] = time
+                nc.variables['lon'][:] = lon
+                nc.variables['lat'][:] = lat
+                nc.variables['aod550'][:] = aod
+                nc.variables['quality_flag'][:] = qf
+                complete = True
+            finally:
+                nc.close()
+                if not complete: os.remove(tmp)
+            os.rename(tmp, ncfile)
+            print dt.utcnow().strftime('%T') + ' done.'
+            return
+
+        # Append granules as they are decoded
+        nc, tmp, n, last, complete = None, None, 0, None, False
+        try:
+            for meta, data in self.iterGranules(filepath=filepath,
+                                                skip_download=skip, **kw):
+                if nc is None:
+                    tmp = os.path.join(
+                        os.path.dirname(ncfile) if ncfile else self.local,
+                        '.%s.%d.nc.tmp' % (self.product, os.getpid()))
+                    nc = Dataset(tmp, 'w', clobber=True, format=ncformat)
+                    self._defineNcAod(nc, None, **opts)
+                last = meta['filename']
+                k = meta['nsamples']
+                if k == 0: continue
+                for name in _GRANULE_FIELDS:
+                    nc.variables[name][n:n + k] = data[name]
+                n += k
+            complete = True
+        finally:
+            if nc is not None:
+                nc.close()
+                if not complete: os.remove(tmp)
+
+        # Do not publish a partial day if the download failed
+        if self.status[0] != 0:
+            if tmp is not None: os.remove(tmp)
+            self.status[1] = -1
+            return -1
+        if last is None:
+            print 'No Level-2 files in ' + str(self.local)
+            self.status[1] = -1
+            return -1
+        print ' done'
+        self.setDayNames(last)
         if ncfile is None:
             ncfile = os.path.join(self.local, self.daybase + '.nc')
+        os.rename(tmp, ncfile)
+        print dt.utcnow().strftime('%T') + ' Written ' + ncfile + \
+            ' ({0} samples)'.format(n)
 
-        print dt.utcnow().strftime('%T') + ' Writing ' + ncfile
-        nc = Dataset(ncfile, 'w', clobber=True, format=ncformat)
 
+    def _defineNcAod(self, nc, size, chunksize=65536, complevel=4,
+                     shuffle=True):
+        '''Add global attributes, the sample dimension 't' (unlimited if
+        size is None) and the daily AOD variables to an open netCDF file.'''
         # Add Global attributes
         nc.title = self.product
         nc.description = 'MODIS daily aerosol fields accumulated ' + \
@@ -452,33 +1726,35 @@ class Level2Files:
         nc.contact = 'yaswant.pradhan@metoffice.gov.uk'
         nc.history = '2016: version 0.1'
 
-        # Define variable dimensions, create variable and add attributes
-        # nc.createDimension('x', None) # create sample dimension unlimited
-        # Note that an unlimited sample dimension is not efficient at all
-        # - creates huge files and take 10x longer for writing
-        nc.createDimension('t', np.size(time))
-        times = nc.createVariable('scan_time', 'd', 't' , zlib=True)
+        # Define variable dimensions, create variable and add attributes.
+        # An unlimited sample dimension is only slow with the default tiny
+        # chunks, so chunk sizes are always set explicitly.
+        nc.createDimension('t', size)
+        chunks = (chunksize if size is None else max(1, min(chunksize, size)),)
+        opts = {'zlib': complevel > 0, 'complevel': max(complevel, 1),
+                'shuffle': shuffle, 'chunksizes': chunks}
+        times = nc.createVariable('scan_time', 'd', 't', **opts)
         times.long_name = 'TAI Time at Start of Scan replicated across the swath'
         times.units = 'Seconds since 1993-1-1 00:00:00.0 0'
-        lons = nc.createVariable('lon', 'f', 't' , zlib=True,
-                                 least_significant_digit=3)
+        lons = nc.createVariable('lon', 'f', 't', least_significant_digit=3,
+                                 **opts)
         lons.long_name = 'Geodetic Longitude'
         lons.standard_name = 'longitude'
         lons.units = 'degrees_east'
-        lats = nc.createVariable('lat', 'f', 't', zlib=True,
-                                 least_significant_digit=3)
+        lats = nc.createVariable('lat', 'f', 't', least_significant_digit=3,
+                                 **opts)
         lats.long_name = 'Geodetic Latitude'
         lats.standard_name = 'latitude'
         lats.units = 'degrees_north'
-        aods = nc.createVariable('aod550', 'f', 't' , zlib=True,
-                                 least_significant_digit=4)
+        aods = nc.createVariable('aod550', 'f', 't', least_significant_digit=4,
+                                 **opts)
         aods.long_name = 'Combined Dark Target, Deep Blue AOT at 0.55 ' + \
                          'micron for land and ocean'
         aods.standard_name = 'atmosphere_optical_thickness_due_to_aerosol'
         aods.units = '1'
         aods.valid_range = [-0.1, 5]
-        qfs = nc.createVariable('quality_flag', 'h', 't', zlib=True,
-                                least_significant_digit=1)
+        qfs = nc.createVariable('quality_flag', 'h', 't',
+                                least_significant_digit=1, **opts)
         qfs.long_name = 'Combined Dark Target, Deep Blue Aerosol ' + \
                         'Confidence Flag'
         qfs.flag_values = [0, 1, 2, 3]
@@ -492,37 +1768,134 @@ class Level2Files:
                           'get AOD retrieval confdence. See http://www-cf/' + \
                           '~cfsa/SPS/build/dev/doc/consolidate_mydl2.html'
 
-        # Fill variables
-        times[:] = time
-        lons[:] = lon
-        lats[:] = lat
-        aods[:] = aod
-        qfs[:] = qf
-        nc.close()
-        print dt.utcnow().strftime('%T') + ' done.'
-
 #===============================================================================
 # Write daily consolidated aod data to netcdf
 #===============================================================================
-    def writeh5DailyAod(self, h5file=None, filepath=None, download=True):
+    def writeh5DailyAod(self, h5file=None, filepath=None, download=True,
+                        **kw):
         '''Write daily consolidated MODIS AOD data to HDF5 file.
+
+        Kwargs:
+         * h5file (str) output hdf5 filename
+         * filepath (str) override default level 2 file path
+         * chunks (int) samples per chunk (def: 65536)
+         * compression (str) 'gzip' (def), 'lzf' or None
+         * level (int) gzip level 1-9 (def: 4)
+         * shuffle (bool) apply shuffle filter (def: True)
+         * scaleoffset (int) quantize lon, lat and aod550 keeping this many
+           decimal digits (lossy; def: None ie exact float32)
+         * stream (bool) create resizable datasets and append granule by
+           granule, holding one granule in memory (def: False)
+         * swmr (bool) stream in single-writer/multiple-reader mode so the
+           growing file can be read (h5py.File(f, 'r', libver='latest',
+           swmr=True)) while granules are appended. The file is written in
+           place and named from the first granule unless h5file is given.
+         * valid_time, pipeline, processes, ...: passed to
+           consolidateDailyAod() / iterGranules()
         '''
         import h5py
         skip = not download
+        opts = dict((k, kw.pop(k, v)) for k, v in
+                    (('chunks', 65536), ('compression', 'gzip'),
+                     ('level', 4), ('shuffle', True), ('scaleoffset', None)))
+        swmr = kw.pop('swmr', False)
+        stream = kw.pop('stream', False) or swmr
+
+        if stream is False:
+            arrays = self.consolidateDailyAod(filepath=filepath,
+                                              skip_download=skip, **kw)
+            if self.status[1] != 0: return -1
+            if h5file is None:
+                h5file = os.path.join(self.local, self.daybase + '.h5')
+
+            print dt.utcnow().strftime('%T') + ' Writing ' + h5file
+            self._writeh5Arrays(h5file, arrays, **opts)
+            print dt.utcnow().strftime('%T') + ' done.'
+            return
+
+        # Append granules to resizable datasets as they are decoded
+        fid, target, n, last, complete = None, None, 0, None, False
+        try:
+            for meta, data in self.iterGranules(filepath=filepath,
+                                                skip_download=skip, **kw):
+                if fid is None:
+                    if swmr:
+                        if h5file is None:
+                            self.setDayNames(meta['filename'])
+                            h5file = os.path.join(self.local,
+                                                  self.daybase + '.h5')
+                        target = h5file
+                        fid = h5py.File(target, 'w', libver='latest')
+                    else:
+                        target = os.path.join(
+                            os.path.dirname(h5file) if h5file else
+                            self.local,
+                            '.%s.%d.h5.tmp' % (self.product, os.getpid()))
+                        fid = h5py.File(target, 'w')
+                    grp = self._defineH5Aod(fid, None, **opts)
+                    if swmr: fid.swmr_mode = True
+                last = meta['filename']
+                k = meta['nsamples']
+                if k == 0: continue
+                for name in _GRANULE_FIELDS:
+                    dset = grp[name]
+                    dset.resize((n + k,))
+                    dset[n:n + k] = data[name]
+                    if swmr: dset.flush()
+                n += k
+            complete = self.status[0] == 0
+        finally:
+            if fid is not None: fid.close()
+            if fid is not None and not complete:
+                if swmr:
+                    # Readers may hold the file open, so set it aside
+                    # rather than delete it
+                    os.rename(target, target + '.incomplete')
+                    print ' ** Incomplete day left in ' + target + \
+                        '.incomplete'
+                else:
+                    os.remove(target)
 
-        time, lon, lat, aod, qf = self.consolidateDailyAod(filepath=filepath,
-                                                           skip_download=skip)
-        if self.status[1] != 0: return -1
-        shp = np.shape(time)  # shape
-
-        # print self.local
-        # print self.daytitle
-        if h5file is None:
-            h5file = os.path.join(self.local, self.daybase + '.h5')
+        if self.status[0] != 0:
+            self.status[1] = -1
+            return -1
+        if last is None:
+            print 'No Level-2 files in ' + str(self.local)
+            self.status[1] = -1
+            return -1
+        if not swmr:
+            self.setDayNames(last)
+            if h5file is None:
+                h5file = os.path.join(self.local, self.daybase + '.h5')
+            os.rename(target, h5file)
+        print ' done'
+        print dt.utcnow().strftime('%T') + ' Written ' + h5file + \
+            ' ({0} samples)'.format(n)
 
-        print dt.utcnow().strftime('%T') + ' Writing ' + h5file
-        fid = h5py.File(h5file, 'w')
 
+    def _writeh5Arrays(self, h5file, arrays, **opts):
+        '''Write consolidated (scan_time, lon, lat, aod550, quality_flag)
+        arrays to a new hdf5 file, via a temporary file renamed on success.'''
+        import h5py
+        tmp = '%s.%d.tmp' % (h5file, os.getpid())
+        fid = h5py.File(tmp, 'w')
+        complete = False
+        try:
+            grp = self._defineH5Aod(fid, np.size(arrays[0]), **opts)
+            # Fill datasets
+            for name, data in zip(_GRANULE_FIELDS, arrays):
+                grp[name][:] = data
+            complete = True
+        finally:
+            fid.close()
+            if not complete: os.remove(tmp)
+        os.rename(tmp, h5file)
+
+
+    def _defineH5Aod(self, fid, size, chunks=65536, compression='gzip',
+                     level=4, shuffle=True, scaleoffset=None):
+        '''Create the product group and daily AOD datasets in an open hdf5
+        file. size None makes resizable (appendable) datasets.'''
         # Create group and add group attributes
         grp = fid.create_group(self.product)
         grp.attrs['title'] = self.product
@@ -533,31 +1906,41 @@ class Level2Files:
         grp.attrs['contact'] = 'yaswant.pradhan@metoffice.gov.uk'
         grp.attrs['history'] = '2016: version 0.1'
 
+        # Dataset storage options
+        if size is None:
+            opts = {'shape': (0,), 'maxshape': (None,), 'chunks': (chunks,)}
+        else:
+            # equal chunks so the last one is not mostly empty
+            nchunk = -(-max(size, 1) // chunks)
+            opts = {'shape': (size,), 'chunks': (-(-max(size, 1) // nchunk),)}
+        if compression is not None:
+            opts.update(compression=compression, shuffle=shuffle,
+                        compression_opts=level if compression == 'gzip'
+                        else None)
+        quant = {'scaleoffset': scaleoffset} if scaleoffset else {}
+
         # Create datasets and add dataset attributes
-        times = grp.create_dataset('scan_time', shape=shp, dtype='d',
-                                   compression='gzip')
+        times = grp.create_dataset('scan_time', dtype='d', **opts)
         times.attrs['long_name'] = 'TAI Time at Start of Scan replicated ' + \
                                    'across the swath'
         times.attrs['units'] = 'Seconds since 1993-1-1 00:00:00.0 0'
-        lons = grp.create_dataset('lon', shape=shp, dtype='f',
-                                  compression='gzip')
+        opts.update(quant)
+        lons = grp.create_dataset('lon', dtype='f', **opts)
         lons.attrs['long_name'] = 'Geodetic Longitude'
         lons.attrs['standard_name'] = 'longitude'
         lons.attrs['units'] = 'degrees_east'
-        lats = grp.create_dataset('lat', shape=shp, dtype='f',
-                                  compression='gzip')
+        lats = grp.create_dataset('lat', dtype='f', **opts)
         lats.attrs['long_name'] = 'Geodetic Latitude'
         lats.attrs['standard_name'] = 'latitude'
         lats.attrs['units'] = 'degrees_north'
-        aods = grp.create_dataset('aod550', shape=shp, dtype='f',
-                                  compression='gzip')
+        aods = grp.create_dataset('aod550', dtype='f', **opts)
         aods.attrs['long_name'] = 'Combined Dark Target, Deep Blue AOT ' + \
                                   'at 0.55 micron for land and ocean'
         aods.attrs['standard_name'] = 'atmosphere_optical_thickness_due_to_aerosol'
         aods.attrs['units'] = '1'
         aods.attrs['valid_range'] = [-0.1, 5]
-        qfs = grp.create_dataset('quality_flag', shape=shp, dtype='H',
-                                 compression='gzip')
+        for k in quant: del opts[k]
+        qfs = grp.create_dataset('quality_flag', dtype='H', **opts)
         qfs.attrs['long_name'] = 'Combined Dark Target, Deep Blue Aerosol ' + \
                                  'Confidence Flag'
         qfs.attrs['flag_values'] = [0, 1, 2, 3]
@@ -571,15 +1954,116 @@ class Level2Files:
                                    'and 2nd bits to get AOD retrieval ' + \
                                    'confdence. See http://www-cf/~cfsa/' + \
                                    'SPS/build/dev/doc/consolidate_mydl2.html'
+        return grp
+
+
+#===============================================================================
+# Compare hdf5 storage settings for daily consolidated aod data
+#===============================================================================
+    def benchmarkh5DailyAod(self, filepath=None, download=False,
+                            settings=None, outdir=None, **kw):
+        '''Write the consolidated day once per hdf5 storage setting and
+        report write time and file size, to choose writeh5DailyAod options.
+
+        Kwargs:
+         * filepath (str) override default level 2 file path
+         * settings (list) dictionaries of writeh5DailyAod storage options
+           (chunks, compression, level, shuffle, scaleoffset)
+           (def: a range of gzip/lzf/shuffle/quantization settings)
+         * outdir (str) directory for the test files (def: temporary
+           directory, removed afterwards)
+
+        Returns:
+         * list of (settings, seconds, bytes) tuples
+        '''
+        import shutil
+        import tempfile
+        if settings is None:
+            settings = [{'compression': None},
+                        {'compression': 'lzf', 'shuffle': False},
+                        {'compression': 'lzf', 'shuffle': True},
+                        {'compression': 'gzip', 'level': 1},
+                        {'compression': 'gzip', 'level': 4},
+                        {'compression': 'gzip', 'level': 9},
+                        {'compression': 'gzip', 'level': 4,
+                         'shuffle': False},
+                        {'compression': 'gzip', 'level': 4,
+                         'scaleoffset': 3},
+                        {'compression': 'lzf', 'scaleoffset': 3}]
+
+        arrays = self.consolidateDailyAod(filepath=filepath,
+                                          skip_download=not download, **kw)
+        if self.status[1] != 0: return -1
+
+        workdir = outdir or tempfile.mkdtemp()
+        results = []
+        try:
+            for i, opts in enumerate(settings):
+                h5file = os.path.join(workdir, 'bench%02d.h5' % i)
+                t0 = time.time()
+                self._writeh5Arrays(h5file, arrays, **opts)
+                results.append((opts, time.time() - t0,
+                                os.path.getsize(h5file)))
+        finally:
+            if outdir is None: shutil.rmtree(workdir)
+
+        raw = sum(a.nbytes for a in arrays)
+        print '{0:>8s} {1:>8s} {2:>7s}  settings'.format('sec', 'MB', 'ratio')
+        for opts, sec, size in results:
+            print '{0:8.3f} {1:8.2f} {2:7.2f}  {3}'.format(
+                sec, size / 1e6, raw / float(size), opts)
+        return results
+
+
+#===============================================================================
+# Write daily consolidated aod data to Parquet
+#===============================================================================
+    def writeparquetDailyAod(self, root=None, filepath=None, download=True,
+                             **kw):
+        '''Write daily consolidated MODIS AOD samples to a columnar Parquet
+        file (requires pyarrow) with columns time (UTC), scan_time (TAI93),
+        lon, lat, aod550 and quality_flag. Rows are sorted and written with
+        per row group min/max statistics, so readers can skip row groups on
+        lat/lon/QA/time predicates.
 
-        # Fill datasets
-        times[:] = time
-        lons[:] = lon
-        lats[:] = lat
-        aods[:] = aod
-        qfs[:] = qf
-        fid.close()
+        Kwargs:
+         * root (str) dataset root; the file goes to
+           root/product=<product>/date=<yyyy-mm-dd>/<daybase>.parquet so a
+           partitioned reader only opens the days it needs
+           (def: None ie <local>/<daybase>.parquet)
+         * filepath (str) override default level 2 file path
+         * sort (str) 'time' (def) or 'space' (latitude band, longitude)
+         * row_group_size (int) rows per row group (def: 131072)
+         * compression (str) Parquet codec (def: 'snappy')
+         * valid_time, pipeline, processes, ...: passed to
+           consolidateDailyAod()
+
+        Returns:
+         * output filename
+        '''
+        sort = kw.pop('sort', 'time')
+        opts = {'row_group_size': kw.pop('row_group_size', 131072),
+                'compression': kw.pop('compression', 'snappy'),
+                'sort_by': 'scan_time' if sort == 'time' else sort}
+
+        time, lon, lat, aod, qf = self.consolidateDailyAod(
+            filepath=filepath, skip_download=not download, **kw)
+        if self.status[1] != 0: return -1
+
+        if root is None:
+            pqfile = os.path.join(self.local, self.daybase + '.parquet')
+        else:
+            day = dt.strptime(self.date, '%Y%m%d').strftime('%Y-%m-%d')
+            pqfile = os.path.join(root, 'product=' + self.product,
+                                  'date=' + day, self.daybase + '.parquet')
+
+        print dt.utcnow().strftime('%T') + ' Writing ' + pqfile
+        write_parquet(pqfile, [('time', tai93_to_datetime64(time)),
+                               ('scan_time', time), ('lon', lon),
+                               ('lat', lat), ('aod550', aod),
+                               ('quality_flag', qf)], **opts)
         print dt.utcnow().strftime('%T') + ' done.'
+        return pqfile
 
 
 #===============================================================================
@@ -694,9 +2178,117 @@ class Level2Files:
 #    Exit
 #===============================================================================
     def __exit__(self, exc_type, exc_value, traceback):
+        self.sessions.close()
         for fi in self.files:
             os.unlink(fi)
 
 
+#===============================================================================
+# Download and consolidate a range of days
+#===============================================================================
+def _process_day(job):
+    '''Download, consolidate and write one product day. Runs in a worker
+    process of consolidate_date_range() and never raises, so that one bad
+    day does not stop the others.
+
+    Returns:
+     * (date, product, status) where status is 0 for success, 1 if the day
+       was already done and -1 on failure
+    '''
+    date, product, kw = job
+    kw = dict(kw)
+    output = kw.pop('output')
+    filepath = kw.pop('filepath')
+    download = kw.pop('download')
+    resume = kw.pop('resume')
+    dlkw = dict((k, kw.pop(k)) for k in ('workers', 'host_limit',
+                                         'valid_time') if k in kw)
+    # Write only the granules in the downloaded time window
+    wkw = dict((k, dlkw[k]) for k in ('valid_time',) if k in dlkw)
+    l2 = None
+    try:
+        l2 = Level2Files(date=date, product=product, **kw)
+        l2.download(destination=filepath, skip_download=True)
+        marker = os.path.join(l2.local, '.done.' + output)
+        if resume is True and os.path.exists(marker):
+            return date, product, 1
+
+        if download is True:
+            l2.download(destination=filepath, **dlkw)
+            if l2.status[0] != 0: return date, product, -1
+
+        write = l2.writeh5DailyAod if output == 'h5' else l2.writencDailyAod
+        if write(filepath=filepath, download=False, **wkw) == -1:
+            return date, product, -1
+        open(marker, 'w').close()
+        return date, product, 0
+    except (Exception, SystemExit) as e:
+        print ' ** {0} {1} failed: {2}'.format(product, date, e)
+        return date, product, -1
+    finally:
+        if l2 is not None: l2.sessions.close()
+
+
+def consolidate_date_range(start, end, products=['MYD04_L2'], processes=4,
+                           output='nc', filepath=None, download=True,
+                           resume=True, max_connections=None, **kw):
+    '''Download and write daily consolidated AOD files for a range of days
+    and products, several days at a time. Each day produces the same nc/h5
+    file as Level2Files.writencDailyAod()/writeh5DailyAod().
+
+    Args:
+     * start (str) First date in YYYYmmdd form
+     * end (str) Last date in YYYYmmdd form (inclusive)
+
+    Kwargs:
+     * products (list) MODIS level2 product codes
+     * processes (int) Maximum number of days processed concurrently
+     * output (str) 'nc' or 'h5'
+     * filepath (str) Level 2 file path root, as for download(destination)
+     * download (bool) Fetch new granules before consolidating
+     * resume (bool) Skip days completed by a previous run (marked with a
+       .done.<output> file in the day directory)
+     * max_connections (int) Cap on concurrent transfers across all days;
+       each day gets workers and host_limit of
+       max(1, max_connections // processes). Without it the load on a
+       server is up to processes x workers connections
+     * workers, host_limit, valid_time: passed to Level2Files.download()
+       for each day
+     * collection, nrt, username, password, aodfields: passed to
+       Level2Files()
+
+    Returns:
+     * list of (date, product, status), see _process_day()
+    '''
+    t0, t1 = dt.strptime(start, '%Y%m%d'), dt.strptime(end, '%Y%m%d')
+    days = [(t0 + td(days=i)).strftime('%Y%m%d')
+            for i in range((t1 - t0).days + 1)]
+    # Most recent first for NRT, so the latest days are ready soonest
+    if kw.get('nrt', False) is True: days.reverse()
+
+    kw.update(output=output, filepath=filepath, download=download,
+              resume=resume)
+    nproc = max(1, min(processes, len(days) * len(products)))
+    if max_connections is not None:
+        # Split the global cap between concurrently processed days
+        share = max(1, int(max_connections) // nproc)
+        kw['workers'] = min(kw.get('workers', share), share)
+        kw['host_limit'] = min(kw.get('host_limit') or share, share)
+    jobs = [(d, p, kw) for d in days for p in products]
+    pool = Pool(processes=nproc)
+    try:
+        status = list(pool.imap(_process_day, jobs, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [s for s in status if s[2] < 0]
+    print dt.utcnow().strftime('%T') + \
+        ' Product days: {0} done, {1} skipped, {2} failed.'.format(
+            len([s for s in status if s[2] == 0]),
+            len([s for s in status if s[2] == 1]), len(failed))
+    return status
+
+
 if __name__ == '__main__':
     pass
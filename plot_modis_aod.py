@@ -1,9 +1,11 @@
 #!/usr/bin/env python2.7
 
-from ypylib.modis_hdf import Level2Files as l2f
+from ypylib.modis_hdf import Level2Files as l2f, GranuleIndex, \
+    latest_versions
 import numpy as np
 from pyhdf.SD import SD, SDC
 from ypylib.geo import wrap_lon
+from ypylib.hdf import sds_array
 import os, glob
 import matplotlib
 if os.environ.get('DISPLAY') is None:
@@ -24,15 +26,28 @@ def plot_c6_granules(filelist=None, **kw):
         figsize
         gline
         cmap
+        index: GranuleIndex (or its SQLite file) to select granules from
+               instead of globbing l2path; with start, end, limit
     '''
     product = kw.get('product', 'MYD04_L2')
-    if filelist is None:
+    index = kw.get('index')
+    if filelist is None and index is not None:
+        idx = GranuleIndex(index) if isinstance(index, basestring) else index
+        if 'l2path' in kw: idx.update(kw['l2path'])
+        filelist = idx.select(product=product, start=kw.get('start'),
+                              end=kw.get('end'), limit=kw.get('limit'),
+                              directory=kw.get('l2path'))
+        if idx is not index: idx.close()
+    elif filelist is None:
         l2path = kw.get('l2path',
                         os.path.join('/data/users/fra6/MODIS_NRT_C6/', product,
                         dt.utcnow().strftime('%Y/%j')))
         filelist = glob.glob(os.path.join(l2path, '*.hdf'))
         # print filelist
 
+    # Skip older versions of reprocessed granules
+    filelist = latest_versions(filelist)[0]
+
     if len(filelist) == 0:
         print "No files found."
         return
@@ -59,51 +74,48 @@ def plot_c6_granules(filelist=None, **kw):
         # print os.path.basename(mfile)
         print ".",
         h4 = SD(mfile, SDC.READ)
-        lon = h4.select('Longitude')
-        lat = h4.select('Latitude')
-        field = h4.select(fieldname)
-        scl = field.attributes()['scale_factor']
+        # Read each field once; scaled proxy masks fill values
+        lon = sds_array(h4.select('Longitude'))[:]
+        lat = sds_array(h4.select('Latitude'))[:]
+        field = sds_array(h4.select(fieldname), scaled=True)[:]
 
         # pdb.set_trace()
-        lon_diff = np.diff(lon[:])
+        lon_diff = np.diff(lon)
 
         ww = np.where((lon_diff < -50) | (lon_diff > 50))
         if len(ww[0]) > 0:
-            if lat[:].max() > 80:
+            if lat.max() > 80:
                 # Use pcolor (slow) for high latitude data..
-                im = m.pcolor(lon[:], lat[:],
-                              np.ma.masked_equal(field[:], -9999) * scl,
+                im = m.pcolor(lon, lat, field,
                               vmin=vmin, vmax=vmax, cmap=cmap)  # , latlon=True)
             else:
                 # split array to get western and eastern parts
-                aod_l, lon_l = field[:], lon[:]
+                aod_l, lon_l = field.copy(), lon.copy()
                 # aod_r, lon_r = field[:], lon[:]
                 i = 0
                 for r in ww[0]:
                     # western hemisphere; mask right part
-                    aod_l[r, ww[1][i]:] = -9999
+                    aod_l[r, ww[1][i]:] = np.ma.masked
                     lon_l[r, ww[1][i]:] = -9999
                     # lon_r[r, :ww[1][i]] = -9999
                     # aod_r[r, :ww[1][i]] = -9999
                     i += 1
 
                 # Plot slices: left part up to 180W
-                im = m.pcolormesh(lon_l[:], lat[:],
-                                  np.ma.masked_equal(aod_l[:], -9999) * scl,
+                im = m.pcolormesh(lon_l, lat, aod_l,
                                   vmin=vmin, vmax=vmax, shading='flat',
                                   cmap=cmap)  # , latlon=True)
                 # right part up to 180E
-                if lat[:].min() > -60.:
-                    im = m.pcolormesh(wrap_lon(lon[:]), lat[:],
-                                      np.ma.masked_equal(field[:], -9999) * scl,
+                if lat.min() > -60.:
+                    im = m.pcolormesh(wrap_lon(lon), lat, field,
                                       vmin=vmin, vmax=vmax, shading='flat',
                                       cmap=cmap)  # , latlon=True)
 
         else:
-            im = m.pcolormesh(lon[:], lat[:],
-                              np.ma.masked_equal(field[:], -9999) * scl,
+            im = m.pcolormesh(lon, lat, field,
                               vmin=vmin, vmax=vmax, shading='flat',
                               cmap=cmap)  # , latlon=True)
+        h4.end()
     print 'done'
     m.drawmapboundary(fill_color='1')
     m.drawparallels(np.arange(-90., 99., 30.), labels=[1, 0, 0, 0],
@@ -15,6 +15,7 @@ from netCDF4 import Dataset
 import numpy as np
 from datetime import datetime as dt
 from ypylib.stat import bin_xyz
+from ypylib.utils import write_parquet
 import matplotlib.pyplot as plt
 from mpl_toolkits.basemap import Basemap
 from ImageMetaTag import savefig
@@ -97,9 +98,16 @@ class Level2Files(object):
                     except KeyError as e:
                         print "Invalid Key:", e
 
-            clon = [val for sublist in clon for val in sublist]
-            clat = [val for sublist in clat for val in sublist]
-            caod = [val for sublist in caod for val in sublist]
+            # Concatenate per-file arrays into contiguous daily arrays
+            if len(caod) > 0:
+                # Keep the netCDF fill masks and drop samples with any fill
+                clon, clat, caod = [np.ma.concatenate(c)
+                                    for c in (clon, clat, caod)]
+                ok = ~(np.ma.getmaskarray(clon) | np.ma.getmaskarray(clat) |
+                       np.ma.getmaskarray(caod))
+                clon, clat, caod = [
+                    np.ma.getdata(c)[ok].astype(np.float32, copy=False)
+                    for c in (clon, clat, caod)]
             print "done"
 
             z = re.split(r"[,\.]", os.path.basename(fi))[2].split('_')
@@ -110,6 +118,44 @@ class Level2Files(object):
         return clon, clat, caod
 
 
+    def writeparquetDailyAod(self, root=None, filepath=None, sat=None,
+                             sort='space', row_group_size=131072,
+                             compression='snappy'):
+        '''Write daily consolidated PMAP AOD (lon, lat, aod550) to a
+        columnar Parquet file (requires pyarrow), sorted so that row group
+        statistics allow readers to skip data outside a lat/lon box.
+
+        Kwargs:
+         * root (str) dataset root; the file goes to
+           root/sat=<sat>/date=<yyyy-mm-dd>/<daybase>.parquet
+           (def: None ie <local>/<daybase>.parquet)
+         * filepath (str) override default PMAP file path
+         * sat (str) satellite (def: self.sat)
+         * sort (str) 'space' (def), or a column name
+         * row_group_size (int) rows per row group (def: 131072)
+         * compression (str) Parquet codec (def: 'snappy')
+
+        Returns:
+         * output filename
+        '''
+        lon, lat, aod = self.consolidateDailyAod(filepath=filepath, sat=sat)
+        if self.status != 0 or len(aod) == 0: return -1
+
+        if root is None:
+            pqfile = os.path.join(self.local, self.daybase + '.parquet')
+        else:
+            day = dt.strptime(self.date, '%Y%m%d').strftime('%Y-%m-%d')
+            pqfile = os.path.join(root, 'sat=' + (sat or self.sat),
+                                  'date=' + day,
+                                  self.daybase + '.parquet')
+
+        print dt.utcnow().strftime('%T') + ' Writing ' + pqfile
+        write_parquet(pqfile, [('lon', lon), ('lat', lat), ('aod550', aod)],
+                      sort_by=sort, row_group_size=row_group_size,
+                      compression=compression)
+        return pqfile
+
+
     def plotDailyAod(self, filepath=None, sat='METOPA',
                      rebin=(0.5, 0.5),
                      figsize=[8, 5],
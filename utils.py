@@ -131,6 +131,55 @@ def write_csv(filename, data=None, header=None, append=False):
 
 
 
+def write_parquet(filename, data, sort_by=None, row_group_size=131072,
+                  compression='snappy'):
+    '''Write columns to a Parquet file (requires pyarrow). Rows can be
+    sorted first so that the min/max statistics stored per row group are
+    tight and readers can skip row groups outside a query. The file is
+    written under a temporary name and renamed, creating parent
+    directories (eg product=X/date=Y partitions) as needed.
+
+    Args:
+     * filename (str) output Parquet filename
+     * data (list) (name, 1D array) column pairs
+
+    Kwargs:
+     * sort_by (str) column name to sort rows by, or 'space' to sort by
+       10 degree latitude band then longitude ('lat' and 'lon' columns)
+       (def: None ie keep order)
+     * row_group_size (int) rows per row group (def: 131072)
+     * compression (str) Parquet codec, eg 'snappy', 'gzip', 'zstd'
+
+    Returns:
+     * number of rows written
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('write_parquet requires pyarrow')
+
+    names = [k for k, _ in data]
+    columns = [np.asarray(v) for _, v in data]
+    if sort_by == 'space':
+        lon, lat = columns[names.index('lon')], columns[names.index('lat')]
+        order = np.lexsort((lon, np.floor((lat + 90.) / 10.)))
+    elif sort_by is not None:
+        order = np.argsort(columns[names.index(sort_by)], kind='mergesort')
+    else:
+        order = None
+    if order is not None:
+        columns = [c[order] for c in columns]
+
+    table = pa.Table.from_arrays([pa.array(c) for c in columns], names=names)
+    if os.path.dirname(filename): mkdirp(os.path.dirname(filename))
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    pq.write_table(table, tmp, row_group_size=row_group_size,
+                   compression=compression, write_statistics=True)
+    os.rename(tmp, filename)
+    return table.num_rows
+
+
 def doy(year=None, month=None, day=None):
     '''Calculate serial day of year
     '''
@@ -175,6 +224,82 @@ def doy2ymd(year, dayofyear):
     import datetime as dt
     return dt.datetime(year, 1, 1) + dt.timedelta(dayofyear - 1)
 
+
+# # TAI93 time (MODIS Scan_Start_Time, seconds since 1993-01-01 incl. leaps)
+_TAI93_EPOCH = np.datetime64('1993-01-01T00:00:00', 'us')
+
+# UTC dates on which a leap second took effect (after the TAI93 epoch);
+# add new IERS Bulletin C announcements here.
+_LEAP_DATES = np.array(['1993-07-01', '1994-07-01', '1996-01-01',
+                        '1997-07-01', '1999-01-01', '2006-01-01',
+                        '2009-01-01', '2012-07-01', '2015-07-01',
+                        '2017-01-01'], dtype='datetime64[s]')
+
+# ...as seconds since the epoch without leaps (UTC) and with leaps (TAI93)
+_LEAP_UTC = (_LEAP_DATES - _TAI93_EPOCH) / np.timedelta64(1, 's')
+_LEAP_TAI93 = _LEAP_UTC + np.arange(1, _LEAP_DATES.size + 1)
+
+
+def _leaps(table, seconds):
+    '''Number of leap seconds in table at or before seconds. Data within a
+    single leap-second interval (eg a day of granules) needs no per-value
+    search.'''
+    finite = seconds[np.isfinite(seconds)]
+    if finite.size == 0: return 0
+    lo, hi = np.searchsorted(table, [finite.min(), finite.max()],
+                             side='right')
+    if lo == hi: return lo
+    return np.searchsorted(table, seconds, side='right')
+
+
+def tai93_to_datetime64(seconds, unit='us'):
+    '''Convert TAI93 seconds (eg MODIS Scan_Start_Time) to UTC as
+    numpy.datetime64, correcting for the leap seconds since 1993.
+    Non-finite values become NaT.
+
+    Args:
+     * seconds (real or array) seconds since 1993-01-01 00:00:00 TAI93
+
+    Kwargs:
+     * unit (str) datetime64 resolution (def: 'us')
+
+    Returns:
+     * numpy.datetime64 (array) UTC times
+    '''
+    seconds = np.asarray(seconds, dtype=np.float64)
+    scalar = seconds.ndim == 0
+    seconds = np.atleast_1d(seconds)
+    leaps = _leaps(_LEAP_TAI93, seconds)
+    delta = seconds - leaps
+    delta *= np.timedelta64(1, 's') / np.timedelta64(1, unit)
+    np.round(delta, out=delta)
+    bad = ~np.isfinite(delta)
+    if bad.any(): delta[bad] = 0
+    times = _TAI93_EPOCH.astype('datetime64[%s]' % unit) + \
+        delta.astype('timedelta64[%s]' % unit)
+    if bad.any(): times[bad] = np.datetime64('NaT')
+    return times[0] if scalar else times
+
+
+def datetime64_to_tai93(times):
+    '''Convert UTC times to TAI93 seconds, the inverse of
+    tai93_to_datetime64.
+
+    Args:
+     * times (datetime64, datetime, str or array of these) UTC times
+
+    Returns:
+     * float64 (array) seconds since 1993-01-01 00:00:00 TAI93; NaN for NaT
+    '''
+    times = np.asarray(times, dtype='datetime64[us]')
+    scalar = times.ndim == 0
+    times = np.atleast_1d(times)
+    seconds = (times - _TAI93_EPOCH).astype(np.float64)
+    seconds *= 1e-6
+    seconds[np.isnat(times)] = np.nan
+    seconds += _leaps(_LEAP_UTC, seconds)
+    return seconds[0] if scalar else seconds
+
 # # Distance
 def ft2m(feet):
     '''Converts value from feet to metres'''